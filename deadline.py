@@ -0,0 +1,91 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional
+from logger_config import logger
+
+# A hedged second LLM request is fired once this fraction of the remaining budget has passed...
+HEDGE_AFTER_FRACTION = 0.5
+# ...but only if at least this much budget is still left for it to finish in.
+MIN_HEDGE_BUDGET_S = 2.0
+# Budget kept back after the LLM call for mapping the answer and building the response.
+RESPONSE_RESERVE_S = 0.1
+
+# LLM calls made under a deadline run here so the request thread can stop waiting on them.
+llm_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm")
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's time budget runs out; `stage` names where it happened."""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Absolute time budget of one request, created from APIRequest.deadline_ms."""
+
+    def __init__(self, budget_ms: Optional[int]):
+        self.expires_at = time.monotonic() + budget_ms / 1000 if budget_ms else None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None when the request has no deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, default=None):
+        """Timeout in seconds for a blocking call such as requests.get."""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+    def check(self, stage: str):
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(stage)
+
+
+def hedged_invoke(llm, messages, deadline: Deadline):
+    """
+    Invokes the LLM within the deadline, firing one hedged duplicate request when the
+    first one is slow. Returns (ai_msg, hedged) for whichever call answers first.
+
+    Each call is given the budget left at submission as its own timeout, so a call the
+    request stops waiting for ends at the deadline instead of holding an executor thread.
+    `llm` should not retry, or a timed-out call would start over.
+
+    Raises:
+        DeadlineExceeded: if neither call answers before the deadline.
+    """
+    remaining = deadline.remaining()
+    if remaining is None:
+        return llm.invoke(messages), False
+
+    budget = remaining - RESPONSE_RESERVE_S
+    if budget <= 0:
+        raise DeadlineExceeded("llm call")
+
+    primary = llm_executor.submit(llm.invoke, messages, timeout=budget)
+    futures = {primary: False}
+    hedge_at = budget * HEDGE_AFTER_FRACTION
+    if budget - hedge_at >= MIN_HEDGE_BUDGET_S:
+        done, _ = wait([primary], timeout=hedge_at)
+        if not done:
+            logger.info(f"LLM call still running after {hedge_at:.2f}s, firing hedged request")
+            futures[llm_executor.submit(llm.invoke, messages, timeout=max(0.0, deadline.remaining() - RESPONSE_RESERVE_S))] = True
+
+    pending = set(futures)
+    last_error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline.remaining() - RESPONSE_RESERVE_S), return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded("llm call")
+        for future in done:
+            if future.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return future.result(), futures[future]
+            last_error = future.exception()
+            logger.error(f"LLM call failed under deadline: {last_error}")
+    raise last_error
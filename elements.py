@@ -0,0 +1,254 @@
+import sys
+from typing import Any, Dict, Optional, Tuple
+
+# (x1, y1, x2, y2) in screen pixels.
+Rect = Tuple[int, int, int, int]
+
+# Bit positions for the boolean attributes of an interactable element.
+FLAG_ENABLED = 1
+FLAG_FOCUSED = 2
+FLAG_SCROLLABLE = 4
+FLAG_LONG_CLICKABLE = 8
+FLAG_PASSWORD = 16
+FLAG_SELECTED = 32
+
+_FLAG_ATTRIBUTES = (
+    ('enabled', 'enabled', FLAG_ENABLED, 'true'),
+    ('focused', 'focused', FLAG_FOCUSED, 'false'),
+    ('scrollable', 'scrollable', FLAG_SCROLLABLE, 'false'),
+    ('long_clickable', 'long-clickable', FLAG_LONG_CLICKABLE, 'false'),
+    ('password', 'password', FLAG_PASSWORD, 'false'),
+    ('selected', 'selected', FLAG_SELECTED, 'false'),
+)
+
+
+def parse_bounds(bounds) -> Optional[Rect]:
+    """
+    Parses an Android bounds string like "[0,0][100,100]" into integer coordinates.
+
+    Returns None when the bounds are missing or malformed.
+    """
+    if not isinstance(bounds, str) or not bounds:
+        return None
+    coords = bounds.replace("][", ",").strip("[]").split(",")
+    if len(coords) != 4:
+        return None
+    try:
+        x1, y1, x2, y2 = map(int, coords)
+    except ValueError:
+        return None
+    return (x1, y1, x2, y2)
+
+
+def format_bounds(rect: Optional[Rect]) -> str:
+    if rect is None:
+        return ''
+    x1, y1, x2, y2 = rect
+    return f"[{x1},{y1}][{x2},{y2}]"
+
+
+def _intern(value: str) -> str:
+    return sys.intern(value) if value else ''
+
+
+class InteractableElement:
+    """
+    A clickable element extracted from the XML hierarchy.
+
+    Bounds are parsed once into `rect` and the boolean attributes are packed into
+    a single bitmask. Use `to_dict` for the response JSON and `prompt_text` for the LLM.
+    """
+    __slots__ = ('element_id', 'text', 'resource_id', 'type', 'rect', 'content_desc', 'flags', 'xpath')
+
+    def __init__(self, element_id, text='', resource_id='', type='', rect=None, content_desc='', flags=FLAG_ENABLED, xpath=''):
+        self.element_id = element_id
+        self.text = text
+        self.resource_id = resource_id
+        self.type = type
+        self.rect = rect
+        self.content_desc = content_desc
+        self.flags = flags
+        self.xpath = xpath
+
+    @classmethod
+    def from_node(cls, element_id, node, xpath=''):
+        flags = 0
+        for _, attribute, flag, default in _FLAG_ATTRIBUTES:
+            if node.get(attribute, default) == 'true':
+                flags |= flag
+        return cls(
+            element_id=element_id,
+            text=node.get('text', ''),
+            resource_id=_intern(node.get('resource-id', '')),
+            type=_intern(node.tag.split('.')[-1]),
+            rect=parse_bounds(node.get('bounds', '')),
+            content_desc=node.get('content-desc', ''),
+            flags=flags,
+            xpath=xpath,
+        )
+
+    def with_id(self, element_id):
+        if element_id == self.element_id:
+            return self
+        return InteractableElement(element_id, self.text, self.resource_id, self.type, self.rect, self.content_desc, self.flags, self.xpath)
+
+    @property
+    def bounds(self) -> str:
+        return format_bounds(self.rect)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.flags & FLAG_ENABLED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        result = {
+            '_id': self.element_id,
+            'text': self.text,
+            'resource_id': self.resource_id,
+            # Deprecated misspelling kept for existing clients; remove in the next release.
+            'resouce_id': self.resource_id,
+            'type': self.type,
+            'bounds': self.bounds,
+            'content_desc': self.content_desc,
+        }
+        for name, _, flag, _ in _FLAG_ATTRIBUTES:
+            result[name] = bool(self.flags & flag)
+        result['xpath'] = self.xpath
+        return result
+
+    def prompt_text(self) -> str:
+        # Only non-empty fields and non-default flags are rendered to keep the prompt short.
+        parts = [f"_id={self.element_id}", f"type={self.type}"]
+        if self.text:
+            parts.append(f"text={self.text!r}")
+        if self.resource_id:
+            parts.append(f"resource_id={self.resource_id}")
+        if self.content_desc:
+            parts.append(f"content_desc={self.content_desc!r}")
+        if self.rect is not None:
+            parts.append(f"bounds={self.bounds}")
+        if not self.flags & FLAG_ENABLED:
+            parts.append("enabled=false")
+        for name, _, flag, _ in _FLAG_ATTRIBUTES[1:]:
+            if self.flags & flag:
+                parts.append(f"{name}=true")
+        parts.append(f"xpath={self.xpath}")
+        return " ".join(parts)
+
+    def __repr__(self):
+        return f"InteractableElement({self.prompt_text()})"
+
+
+class ContextElement:
+    """A non-clickable text or image element extracted from the XML hierarchy."""
+    __slots__ = ('type', 'text', 'resource_id', 'content_desc', 'rect', 'xpath')
+
+    def __init__(self, type, text='', resource_id='', content_desc='', rect=None, xpath=''):
+        self.type = type
+        self.text = text
+        self.resource_id = resource_id
+        self.content_desc = content_desc
+        self.rect = rect
+        self.xpath = xpath
+
+    @property
+    def bounds(self) -> str:
+        return format_bounds(self.rect)
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.type == 'text':
+            return {'xpath': self.xpath, 'type': self.type, 'text': self.text}
+        return {
+            'xpath': self.xpath,
+            'type': self.type,
+            'resource_id': self.resource_id,
+            'content_desc': self.content_desc,
+            'bounds': self.bounds,
+        }
+
+    def prompt_text(self) -> str:
+        if self.type == 'text':
+            return f"text {self.text!r}"
+        parts = ["image"]
+        if self.resource_id:
+            parts.append(f"resource_id={self.resource_id}")
+        if self.content_desc:
+            parts.append(f"content_desc={self.content_desc!r}")
+        if self.rect is not None:
+            parts.append(f"bounds={self.bounds}")
+        return " ".join(parts)
+
+    def __repr__(self):
+        return f"ContextElement({self.prompt_text()})"
+
+
+class ActionableElement:
+    """
+    A client-supplied actionable element (see `process_actionable_elements`).
+
+    `attributes` keeps the raw name/value pairs sent by the client; `rect` is
+    parsed from its "bounds" attribute once.
+    """
+    __slots__ = ('node_id', 'description', 'heuristic_score', 'attributes', 'rect')
+
+    def __init__(self, node_id, description='', heuristic_score=0, attributes=None):
+        self.node_id = node_id
+        self.description = description
+        self.heuristic_score = heuristic_score
+        self.attributes = attributes or {}
+        self.rect = parse_bounds(self.attributes.get('bounds'))
+
+    @property
+    def text(self) -> str:
+        # Clients do not always send the text as an attribute; the description starts with it.
+        return self.attributes.get('text', '') or self.description
+
+    @property
+    def resource_id(self) -> str:
+        return self.attributes.get('resource_id', '') or ''
+
+    @property
+    def content_desc(self) -> str:
+        return self.attributes.get('content_desc', '') or ''
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "node_id": self.node_id,
+            "description": self.description,
+            "heuristic_score": self.heuristic_score,
+            "attributes": self.attributes,
+        }
+
+    def prompt_text(self) -> str:
+        parts = [f"_id={self.node_id}", f"description={self.description!r}"]
+        if self.rect is not None:
+            parts.append(f"bounds={format_bounds(self.rect)}")
+        return " ".join(parts)
+
+    def __repr__(self):
+        return f"ActionableElement({self.prompt_text()})"
+
+
+def popup_details_to_prompt(popup_result) -> str:
+    """Renders the output of `extract_popup_details` as compact prompt text."""
+    lines = [f"is_popup: {popup_result.get('is_popup', False)}"]
+    details = popup_result.get('details', {})
+    if details:
+        lines.append("details: " + ", ".join(f"{key}={value}" for key, value in details.items()))
+    changes = popup_result.get('changes')
+    if changes:
+        lines.append(
+            f"changes since previous screen: bounds={changes['bounds'] or 'none'}, "
+            f"added={len(changes['added'])}, removed={len(changes['removed'])}, changed={len(changes['changed'])}"
+        )
+    lines.append("content:")
+    lines.extend(f"- {element.prompt_text()}" for element in popup_result.get('content', []))
+    lines.append("interactable_elements:")
+    lines.extend(f"- {element.prompt_text()}" for element in popup_result.get('interactable_elements', {}).values())
+    return "\n".join(lines)
+
+
+def element_metadata(elements, element_id) -> Dict[str, Any]:
+    """Returns the response JSON for `element_id`, or an empty dict if it is unknown."""
+    element = elements.get(element_id) if elements else None
+    return element.to_dict() if element is not None else {}
@@ -0,0 +1,141 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import requests
+from logger_config import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the worker pool's backlog is full."""
+
+
+class Job:
+    """A submitted request and its outcome. The request itself is dropped once the job has run."""
+    __slots__ = ('job_id', 'request_id', 'request', 'callback_url', 'state', 'result', 'callback_status', 'created_at', 'finished_at')
+
+    def __init__(self, request, callback_url=None):
+        self.job_id = uuid.uuid4().hex
+        self.request_id = request.request_id
+        self.request = request
+        self.callback_url = callback_url
+        self.state = QUEUED
+        self.result = None
+        self.callback_status = "pending" if callback_url else None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        job = {
+            "job_id": self.job_id,
+            "request_id": self.request_id,
+            "state": self.state,
+            "created_at": self.created_at,
+        }
+        if self.state == COMPLETED:
+            job["finished_at"] = self.finished_at
+            job["result"] = self.result
+        if self.callback_url:
+            job["callback_status"] = self.callback_status
+        return job
+
+
+class JobStore:
+    """
+    Thread-safe job registry. Completed jobs are evicted `ttl_s` seconds after they complete,
+    and the oldest are evicted early once more than `max_completed` are held.
+    """
+
+    def __init__(self, ttl_s: float = 900, max_completed: int = 1024):
+        self.ttl_s = ttl_s
+        self.max_completed = max_completed
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl_s
+        completed = sorted(
+            (job.finished_at, job_id) for job_id, job in self._jobs.items() if job.finished_at is not None
+        )
+        excess = len(completed) - self.max_completed
+        for index, (finished_at, job_id) in enumerate(completed):
+            if finished_at >= cutoff and index >= excess:
+                break
+            del self._jobs[job_id]
+
+    def add(self, job: Job):
+        with self._lock:
+            self._evict_expired()
+            self._jobs[job.job_id] = job
+
+    def get(self, job_id) -> Optional[Job]:
+        with self._lock:
+            self._evict_expired()
+            return self._jobs.get(job_id)
+
+
+class JobManager:
+    """
+    Runs requests on a bounded in-process worker pool and keeps their results in a JobStore.
+
+    At most `max_pending` jobs may be queued or running at once; further submissions raise
+    JobQueueFull. Completed results are delivered to the job's callback URL, if any.
+    """
+
+    def __init__(self, handler: Callable[[Any], Dict[str, Any]], workers: int = 8, max_pending: int = 256,
+                 ttl_s: float = 900, max_completed: int = 1024, callback_timeout_s: float = 10, callback_attempts: int = 3):
+        self.handler = handler
+        self.store = JobStore(ttl_s, max_completed)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.callback_timeout_s = callback_timeout_s
+        self.callback_attempts = callback_attempts
+
+    def submit(self, request, callback_url=None) -> Job:
+        if not self.slots.acquire(blocking=False):
+            raise JobQueueFull("Too many pending jobs")
+        job = Job(request, callback_url)
+        self.store.add(job)
+        self.executor.submit(self._run, job)
+        logger.info(f"Queued job {job.job_id} for request {request.request_id}")
+        return job
+
+    def get(self, job_id) -> Optional[Job]:
+        return self.store.get(job_id)
+
+    def _run(self, job: Job):
+        try:
+            job.state = RUNNING
+            try:
+                job.result = self.handler(job.request)
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed: {e}")
+                job.result = {"status": "error", "message": "An unexpected error occurred.", "details": str(e), "code": 500}
+            # The request may hold a large base64 screenshot; only its id is kept from here on.
+            job.request = None
+            job.finished_at = time.time()
+            job.state = COMPLETED
+        finally:
+            self.slots.release()
+        if job.callback_url:
+            self._deliver_callback(job)
+
+    def _deliver_callback(self, job: Job):
+        payload = job.to_dict()
+        for attempt in range(1, self.callback_attempts + 1):
+            try:
+                response = requests.post(job.callback_url, json=payload, timeout=self.callback_timeout_s)
+                response.raise_for_status()
+                job.callback_status = "delivered"
+                logger.info(f"Delivered job {job.job_id} to {job.callback_url}")
+                return
+            except Exception as e:
+                logger.error(f"Callback for job {job.job_id} failed (attempt {attempt}/{self.callback_attempts}): {e}")
+                if attempt < self.callback_attempts:
+                    time.sleep(2 ** (attempt - 1))
+        job.callback_status = "failed"
@@ -0,0 +1,172 @@
+import base64
+import binascii
+import json
+import os
+import xml.etree.ElementTree as ET
+from io import BytesIO
+import requests
+from PIL import Image
+from logger_config import logger
+
+# Upper bounds on the work a single request may cause; each can be overridden from the environment.
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(25 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(25_000_000)))
+MAX_XML_NODES = int(os.getenv("MAX_XML_NODES", "20000"))
+MAX_XML_DEPTH = int(os.getenv("MAX_XML_DEPTH", "200"))
+
+# PIL refuses to decode anything larger, wherever the image is opened.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# XML is fed to the pull parser in chunks of this many characters.
+XML_CHUNK_SIZE = 64 * 1024
+
+# Downloads are read in chunks of this many bytes.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class InputTooLarge(Exception):
+    """Raised when a request input exceeds one of the configured limits."""
+
+
+def check_image(base64_string: str) -> bytes:
+    """
+    Validates a base64 screenshot and checks its pixel count from the image header alone.
+
+    Returns:
+        The decoded image bytes, to be passed on so later stages need not decode again.
+
+    Raises:
+        ValueError: if the data is not valid base64 or not a readable image.
+        InputTooLarge: if the encoded size or the pixel count exceeds the limits.
+    """
+    if len(base64_string) > MAX_REQUEST_BYTES:
+        raise InputTooLarge(f"Image is {len(base64_string)} bytes encoded, the limit is {MAX_REQUEST_BYTES}")
+    try:
+        image_data = base64.b64decode(base64_string)
+    except (binascii.Error, ValueError):
+        raise ValueError("Invalid base64 image data")
+    try:
+        # Image.open only reads the header; pixels are not decoded here.
+        width, height = Image.open(BytesIO(image_data)).size
+    except Image.DecompressionBombError:
+        raise InputTooLarge(f"Image exceeds {MAX_IMAGE_PIXELS} pixels")
+    except Exception:
+        raise ValueError("Invalid image data")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise InputTooLarge(f"Image is {width}x{height} pixels, the limit is {MAX_IMAGE_PIXELS}")
+    return image_data
+
+
+def fetch_limited(url: str, timeout=None, max_bytes: int = MAX_REQUEST_BYTES) -> bytes:
+    """
+    Downloads `url`, stopping as soon as more than `max_bytes` have arrived instead of
+    buffering an arbitrarily large response first.
+
+    Raises:
+        InputTooLarge: if the declared or actual response size exceeds `max_bytes`.
+        requests.RequestException: if the download fails.
+    """
+    with requests.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length", "")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            raise InputTooLarge(f"{url} is {content_length} bytes, the limit is {max_bytes}")
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            received += len(chunk)
+            if received > max_bytes:
+                raise InputTooLarge(f"{url} exceeds {max_bytes} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def parse_xml_with_limits(xml_content):
+    """
+    Parses XML incrementally, rejecting it as soon as it exceeds the node count or depth limits
+    instead of building the whole tree first. `xml_content` may be str or bytes; bytes are
+    decoded according to the XML declaration.
+
+    Returns:
+        The root element.
+
+    Raises:
+        InputTooLarge: if the hierarchy exceeds MAX_XML_NODES or MAX_XML_DEPTH.
+        ET.ParseError: if the XML is malformed.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    nodes = 0
+    depth = 0
+    for offset in range(0, len(xml_content), XML_CHUNK_SIZE):
+        parser.feed(xml_content[offset:offset + XML_CHUNK_SIZE])
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = element
+                nodes += 1
+                depth += 1
+                if nodes > MAX_XML_NODES:
+                    raise InputTooLarge(f"XML has more than {MAX_XML_NODES} nodes")
+                if depth > MAX_XML_DEPTH:
+                    raise InputTooLarge(f"XML is deeper than {MAX_XML_DEPTH} levels")
+            else:
+                depth -= 1
+    parser.close()
+    return root
+
+
+class RequestSizeLimitMiddleware:
+    """
+    ASGI middleware rejecting request bodies larger than `max_bytes` with a 413.
+
+    A declared Content-Length is checked before anything is read. Bodies without one
+    (chunked uploads) are read up to the limit and passed on only if they stay within it.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            if content_length.isdigit() and int(content_length) > self.max_bytes:
+                await self._reject(send, content_length.decode())
+                return
+            await self.app(scope, receive, send)
+            return
+
+        messages = []
+        received = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            received += len(message.get("body", b""))
+            if received > self.max_bytes:
+                await self._reject(send, f"at least {received}")
+                return
+            if not message.get("more_body", False):
+                break
+
+        async def replay_receive():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        await self.app(scope, replay_receive, send)
+
+    async def _reject(self, send, size):
+        logger.error(f"Rejected request of {size} bytes, the limit is {self.max_bytes}")
+        body = json.dumps({"status": "error", "message": f"Request body exceeds {self.max_bytes} bytes", "code": 413}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,12 +1,14 @@
 from langchain_openai import ChatOpenAI
 
-def initialize_llm(OPENAI_API_KEY):
+def initialize_llm(OPENAI_API_KEY, timeout=120, max_retries=2):
 
+    # A finite timeout keeps a stuck call from holding a worker forever; per-request
+    # deadlines (APIRequest.deadline_ms) are enforced on top of it in deadline.py.
     return ChatOpenAI(
         model="gpt-4o",
         temperature=0,
         max_tokens=None,
-        timeout=None,
-        max_retries=2,
+        timeout=timeout,
+        max_retries=max_retries,
         api_key=OPENAI_API_KEY,
     )
\ No newline at end of file
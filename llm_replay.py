@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+from langchain_core.messages import AIMessage
+from logger_config import logger
+
+PASSTHROUGH = "passthrough"
+RECORD = "record"
+REPLAY = "replay"
+MODES = (PASSTHROUGH, RECORD, REPLAY)
+
+
+class ReplayMissError(LookupError):
+    """Raised in replay mode when no completion was recorded for a message list."""
+
+
+def hash_messages(messages) -> str:
+    """Stable SHA-256 over a message list, including any inline images."""
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RecordReplayLLM:
+    """
+    Wraps a chat model with a record/replay layer keyed by the message list hash.
+
+    - passthrough: calls the model normally.
+    - record: calls the model and stores the raw completion and usage under the hash.
+    - replay: serves stored completions without calling the model; a miss raises
+      ReplayMissError so regressions in the prompts show up instead of hitting OpenAI.
+    """
+
+    def __init__(self, llm, mode=PASSTHROUGH, directory="llm_recordings"):
+        if mode not in MODES:
+            raise ValueError(f"Invalid LLM replay mode: {mode}. Expected one of {MODES}.")
+        self.llm = llm
+        self.mode = mode
+        self.directory = directory
+        self._lock = threading.Lock()
+        if mode != PASSTHROUGH:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def invoke(self, messages, **kwargs):
+        # kwargs such as a per-call timeout go to the wrapped LLM and are not part of the recording key.
+        if self.mode == PASSTHROUGH:
+            return self.llm.invoke(messages, **kwargs)
+
+        key = hash_messages(messages)
+        if self.mode == REPLAY:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as recording:
+                    stored = json.load(recording)
+            except FileNotFoundError:
+                raise ReplayMissError(f"No recorded completion for message hash {key}")
+            logger.info(f"Replayed LLM completion {key}")
+            return AIMessage(content=stored["content"], usage_metadata=stored.get("usage_metadata"))
+
+        ai_msg = self.llm.invoke(messages, **kwargs)
+        stored = {"content": ai_msg.content, "usage_metadata": getattr(ai_msg, "usage_metadata", None)}
+        # Write to a temporary file first so concurrent replays never read a partial recording.
+        with self._lock:
+            temp_path = f"{self._path(key)}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as recording:
+                json.dump(stored, recording, ensure_ascii=False)
+            os.replace(temp_path, self._path(key))
+        logger.info(f"Recorded LLM completion {key}")
+        return ai_msg
+
+    def record_request(self, payload: dict):
+        """Appends an incoming request payload to the recording so the traffic can be replayed later."""
+        if self.mode != RECORD:
+            return
+        with self._lock:
+            with open(os.path.join(self.directory, "requests.jsonl"), "a", encoding="utf-8") as requests_file:
+                requests_file.write(json.dumps(payload, ensure_ascii=False) + "\n")
@@ -1,10 +1,17 @@
-from request_processing_utils import process_request_with_image_and_actionable_elements, process_request_with_image_only, process_request_with_xml_only
-from utils import encode_image, extract_popup_details, process_actionable_elements
+from request_processing_utils import fallback_response, llm, process_request_with_image_and_actionable_elements, process_request_with_image_only, process_request_with_xml_only, response_cache, response_cache_key
+from deadline import Deadline, DeadlineExceeded
+from popup_signatures import popup_region_elements, signature_library, signature_response
+from jobs import JobManager, JobQueueFull
+from limits import InputTooLarge, RequestSizeLimitMiddleware, check_image, fetch_limited
+from profiling import StageProfiler
+from utils import encode_image, extract_popup_details, failed_popup_result, popup_region, process_actionable_elements
+from llm_replay import REPLAY
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from typing import Optional, Any
-import base64
 import json
+import os
+import requests
 from logger_config import logger
 import time
 import uuid
@@ -14,6 +21,8 @@ from langsmith import traceable, get_current_run_tree
 
 app = FastAPI()
 
+signatures_enabled = os.getenv("POPUP_SIGNATURES_ENABLED", "true").lower() == "true"
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], 
@@ -32,6 +41,9 @@ async def log_requests(request: Request, call_next):
     logger.info(f"Response status: {response.status_code}")
     return response
 
+# Oversized bodies are rejected before they are parsed, chunked uploads included.
+app.add_middleware(RequestSizeLimitMiddleware)
+
 class APIRequest(BaseModel):
     request_id: Optional[str] = uuid.uuid4().hex
     run_id: Optional[str] = None
@@ -42,75 +54,157 @@ class APIRequest(BaseModel):
     xml_url: Optional[str] = None      # XML URL option
     image_url: Optional[str] = None    # Image URL option
     actionable_elements : Optional[list[Any]] = []
-
-def validate_base64(base64_string: str) -> bool:
-    try:
-        base64.b64decode(base64_string)
-        return True
-    except Exception:
-        return False
+    deadline_ms: Optional[int] = None  # Time budget for the whole request, in milliseconds
+    profile_memory: bool = False       # Report tracemalloc peak memory per stage
 
 @traceable
-def detect_popup(request, encoded_image, processed_xml, actionable_element_dict):
+def detect_popup(request, encoded_image, processed_xml, actionable_element_dict, deadline=None, image_data=None):
 
     rt = get_current_run_tree()
     if rt:
         rt.metadata["request_id"] = request.request_id
         rt.metadata["run_id"] = request.run_id
         rt.metadata["node_id"] = request.node_id
+    # Known system and SDK dialogs are answered from the signature library without the LLM,
+    # only when the XML detector found a popup region, and only from the elements inside it.
+    signature_match = None
+    region_elements = popup_region_elements(processed_xml) if signatures_enabled and not request.actionable_elements else None
+    if region_elements:
+        popup_elements, popup_content = region_elements
+        signature_match = signature_library.match(popup_elements, popup_content, request.testcase_desc)
+        if signature_match:
+            logger.info(f"Matched known popup signature: {signature_match['name']}")
+
+    if signature_match:
+        final_response = signature_response(signature_match, popup_elements)
     # Case 1: Both image and XML or actionable elements provided
-    if encoded_image:
+    elif encoded_image:
         if actionable_element_dict:
             logger.info("Both image and actionable elements available")
-            final_response = process_request_with_image_and_actionable_elements(testcase_desc=request.testcase_desc, encoded_image=encoded_image, actionable_element_dict=actionable_element_dict)
+            final_response = process_request_with_image_and_actionable_elements(testcase_desc=request.testcase_desc, encoded_image=encoded_image, actionable_element_dict=actionable_element_dict, deadline=deadline, popup_region=popup_region(processed_xml), image_data=image_data)
         # Case 3: Only image provided
         else:
-            final_response = process_request_with_image_only(request=request, encoded_image=encoded_image)
+            final_response = process_request_with_image_only(request=request, encoded_image=encoded_image, deadline=deadline, image_data=image_data)
     # Case 2: Only XML provided
     elif processed_xml:
-        final_response = process_request_with_xml_only(request=request, processed_xml=processed_xml)
+        final_response = process_request_with_xml_only(request=request, processed_xml=processed_xml, deadline=deadline)
     else:
         raise HTTPException(
             status_code=400,
             detail="Either XML (string/URL) or image (base64/URL) must be provided."
         )
 
+    if final_response.get("status") == "success" and final_response.get("resolved_by", "").startswith("llm"):
+        response_cache.put(response_cache_key(request), final_response)
+
     final_response['request_id'] = request.request_id
     logger.info(f"Final response: {final_response}")
     return final_response
 
 
-@traceable
-@app.post("/invoke")
-async def run_service(request: APIRequest):
+def fetch_xml(xml_url, timeout=None) -> Optional[str]:
+    """
+    Downloads the XML at `xml_url`, or returns None if it cannot be fetched. In replay mode
+    nothing is downloaded; recorded traffic carries the fetched XML inline.
+    """
+    if llm.mode == REPLAY:
+        logger.warning(f"Not fetching {xml_url} in replay mode")
+        return None
+    try:
+        return fetch_limited(xml_url, timeout=timeout).decode("utf-8", errors="replace")
+    except requests.RequestException as e:
+        logger.error(f"Could not fetch XML from {xml_url}: {e}")
+        return None
+
+def recorded_payload(request: APIRequest, encoded_image, xml_content):
+    """The request as recorded for replay, with fetched URLs replaced by their content."""
+    payload = request.model_dump()
+    if request.image_url and not request.image and encoded_image is not None:
+        payload["image"] = encoded_image
+        payload["image_url"] = None
+    if request.xml_url and not request.xml and xml_content is not None:
+        payload["xml"] = xml_content
+        payload["xml_url"] = None
+    return payload
+
+def process_api_request(request: APIRequest):
+    profiler = StageProfiler(trace_memory=request.profile_memory)
     try:
+        final_response = run_request_stages(request, profiler)
+    finally:
+        report = profiler.report()
+    final_response.update(report)
+    return final_response
 
-        processed_xml = None
+def run_request_stages(request: APIRequest, profiler: StageProfiler):
+    processed_xml = None
+    try:
         encoded_image = None
+        xml_content = None
+        image_data = None  # Decoded once here and passed on to the annotators and the overlay detector.
         actionable_element_dict = {}
+        deadline = Deadline(request.deadline_ms)
 
         # Process image if provided
-        if request.image:
-            if not validate_base64(request.image):
-                raise HTTPException(status_code=400, detail="Invalid base64 image data")
-            encoded_image = request.image
-        elif request.image_url:
-            logger.info(f"Image URL: {request.image_url}")
-            encoded_image = encode_image(request.image_url)
+        # Sizes are checked from the image header before anything decodes the pixels.
+        with profiler.stage("input_validation"):
+            if request.image:
+                try:
+                    image_data = check_image(request.image)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                encoded_image = request.image
+        if request.image_url and not request.image:
+            with profiler.stage("image_fetch"):
+                logger.info(f"Image URL: {request.image_url}")
+                if llm.mode == REPLAY:
+                    logger.warning(f"Not fetching {request.image_url} in replay mode")
+                else:
+                    encoded_image = encode_image(request.image_url, timeout=deadline.timeout())
+                # A failed fetch leaves the request to the XML, as before.
+                if encoded_image is None:
+                    logger.warning(f"Could not fetch image from {request.image_url}, continuing without it")
+                else:
+                    try:
+                        image_data = check_image(encoded_image)
+                    except ValueError as e:
+                        raise HTTPException(status_code=400, detail=f"Image URL did not return a valid image: {e}")
+        deadline.check("image fetch")
 
         # Process XML if provided
-        if request.xml:
-            processed_xml = extract_popup_details(request.xml)
-        elif request.xml_url:
-            logger.info(f"XML URL: {request.xml_url}")
-            processed_xml = extract_popup_details(request.xml_url)
+        # Hierarchies within a run are diffed against the previous one of the same run.
+        cache_key = request.run_id or None
+        with profiler.stage("xml_parsing"):
+            if request.xml:
+                processed_xml = extract_popup_details(request.xml, cache_key=cache_key, node_id=request.node_id)
+            elif request.xml_url:
+                logger.info(f"XML URL: {request.xml_url}")
+                xml_content = fetch_xml(request.xml_url, timeout=deadline.timeout())
+                if xml_content is None:
+                    processed_xml = failed_popup_result(f"Could not fetch {request.xml_url}")
+                else:
+                    processed_xml = extract_popup_details(xml_content, cache_key=cache_key, node_id=request.node_id)
+        # Recorded once the URLs are resolved, so replaying the traffic never touches the network.
+        llm.record_request(recorded_payload(request, encoded_image, xml_content))
+        deadline.check("xml parsing")
 
         if request.actionable_elements:
             actionable_element_dict = process_actionable_elements(request.actionable_elements)
         elif processed_xml:
             actionable_element_dict = processed_xml.get("interactable_elements", {})
 
-        return detect_popup(request=request, encoded_image=encoded_image, processed_xml=processed_xml, actionable_element_dict=actionable_element_dict)
+        with profiler.stage("detection"):
+            return detect_popup(request=request, encoded_image=encoded_image, processed_xml=processed_xml, actionable_element_dict=actionable_element_dict, deadline=deadline, image_data=image_data)
+
+    except InputTooLarge as size_exc:
+        logger.error(f"Input too large: {str(size_exc)}")
+        return {"status": "error", "message": str(size_exc), "code": 413}
+
+    except DeadlineExceeded as deadline_exc:
+        final_response = fallback_response(request, processed_xml, deadline_exc.stage)
+        final_response['request_id'] = request.request_id
+        logger.info(f"Final response: {final_response}")
+        return final_response
     
     except json.JSONDecodeError as json_exc:
         logger.error(f"JSON decode error: {str(json_exc)}")
@@ -123,10 +217,47 @@ async def run_service(request: APIRequest):
         logger.error(f"Error: {str(e)}")
         return {"status": "error", "message": "An unexpected error occurred.", "details": str(e), "code": 500}
 
+# A plain def, so FastAPI runs the blocking pipeline in its threadpool and the event loop
+# keeps serving /jobs, /health and other requests meanwhile.
+@traceable
+@app.post("/invoke")
+def run_service(request: APIRequest):
+    return process_api_request(request)
+
+class JobRequest(APIRequest):
+    callback_url: Optional[str] = None  # Optional URL the finished job is POSTed to
+
+job_manager = JobManager(
+    handler=process_api_request,
+    workers=int(os.getenv("JOB_WORKERS", "8")),
+    max_pending=int(os.getenv("JOB_MAX_PENDING", "256")),
+    ttl_s=float(os.getenv("JOB_RESULT_TTL_S", "900")),
+    max_completed=int(os.getenv("JOB_MAX_COMPLETED", "1024"))
+)
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: JobRequest):
+    try:
+        job = job_manager.submit(request, callback_url=request.callback_url)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return {"status": "accepted", "job_id": job.job_id, "request_id": request.request_id}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job.to_dict()
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def metrics():
+    return {"popup_signatures": signature_library.metrics()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8004)
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Calibrates the local overlay detector's no-popup threshold over a labelled screenshot set.
+
+The dataset directory must contain two sub-directories of screenshots:
+
+    <dataset>/popup/      screens showing a modal, dialog or bottom sheet
+    <dataset>/no_popup/   screens without one
+
+    python overlay_benchmark.py <dataset> --max-miss-rate 0.0
+
+For each candidate threshold it reports how many no-popup screens would be answered
+locally and how many popups would be missed, then recommends the highest threshold
+whose miss rate stays within --max-miss-rate. Set it as OVERLAY_NO_POPUP_THRESHOLD.
+"""
+import argparse
+import base64
+import json
+import os
+import time
+from overlay_detector import classify_overlay
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def score_directory(directory):
+    scores = []
+    latencies = []
+    for name in sorted(os.listdir(directory)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(directory, name), 'rb') as image_file:
+            encoded_image = base64.b64encode(image_file.read()).decode()
+        start_time = time.perf_counter()
+        result = classify_overlay(encoded_image)
+        latencies.append(time.perf_counter() - start_time)
+        scores.append((name, result['score'], result['signals']))
+    return scores, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", help="Directory containing popup/ and no_popup/ screenshots")
+    parser.add_argument("--max-miss-rate", type=float, default=0.0, help="Tolerated fraction of popups answered as no popup")
+    parser.add_argument("--verbose", action="store_true", help="Print per-screenshot scores")
+    args = parser.parse_args()
+
+    popup_scores, popup_latencies = score_directory(os.path.join(args.dataset, "popup"))
+    clean_scores, clean_latencies = score_directory(os.path.join(args.dataset, "no_popup"))
+    if not popup_scores or not clean_scores:
+        parser.error("Both popup/ and no_popup/ must contain screenshots.")
+
+    if args.verbose:
+        for label, scores in (("popup", popup_scores), ("no_popup", clean_scores)):
+            for name, score, signals in scores:
+                print(f"{label}\t{name}\t{score:.4f}\t{json.dumps(signals)}")
+
+    # Every distinct score is a candidate: a threshold just above it answers that screen locally.
+    candidates = sorted({score for _, score, _ in popup_scores + clean_scores} | {0.0})
+    rows = []
+    for threshold in candidates:
+        missed = sum(1 for _, score, _ in popup_scores if score < threshold)
+        skipped = sum(1 for _, score, _ in clean_scores if score < threshold)
+        rows.append({
+            "threshold": round(threshold, 4),
+            "miss_rate": round(missed / len(popup_scores), 4),
+            "local_answer_rate": round(skipped / len(clean_scores), 4),
+        })
+
+    eligible = [row for row in rows if row["miss_rate"] <= args.max_miss_rate]
+    recommended = max(eligible, key=lambda row: row["threshold"]) if eligible else None
+    latencies = popup_latencies + clean_latencies
+    report = {
+        "popup_screens": len(popup_scores),
+        "no_popup_screens": len(clean_scores),
+        "mean_latency_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "max_latency_ms": round(max(latencies) * 1000, 2),
+        "recommended": recommended,
+        "thresholds": rows,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
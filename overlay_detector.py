@@ -0,0 +1,127 @@
+import base64
+import os
+from io import BytesIO
+from typing import Any, Dict
+import numpy as np
+from PIL import Image
+
+# Screens are analysed as small grayscale thumbnails of this width.
+THUMBNAIL_WIDTH = 192
+
+# Fraction of the screen height taken by the status bar and navigation bar, ignored by every signal.
+SYSTEM_BAR_FRACTION = 0.05
+
+# A screen whose strongest overlay signal is below this score is answered locally as "no popup".
+# The default is uncalibrated: it was only checked on synthetic screens, and a bottom banner
+# without a scrim can score below it. Calibrate with overlay_benchmark.py over a real labelled
+# screenshot set and override with the OVERLAY_NO_POPUP_THRESHOLD environment variable.
+NO_POPUP_THRESHOLD = float(os.getenv("OVERLAY_NO_POPUP_THRESHOLD", "0.2"))
+
+# Ratio of fine- to coarse-scale gradient energy of sharp content; blurred content falls well below it.
+SHARP_ENERGY_RATIO = 0.4
+
+# Minimum per-row luminance gap between the center and the screen edges for a row to belong to a card.
+CARD_ROW_CONTRAST = 0.12
+
+
+def load_thumbnail(encoded_image: str, image_data: bytes = None) -> np.ndarray:
+    """
+    Decodes a base64 screenshot into a float32 grayscale thumbnail with values in [0, 1].
+    Already decoded bytes can be given as `image_data` instead.
+    """
+    if image_data is None:
+        image_data = base64.b64decode(encoded_image)
+    image = Image.open(BytesIO(image_data))
+    # For JPEGs this lets the decoder skip most of the full-resolution work.
+    image.draft('L', (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * image.height // max(image.width, 1)))
+    image = image.convert('L')
+    height = max(1, round(image.height * THUMBNAIL_WIDTH / max(image.width, 1)))
+    image = image.resize((THUMBNAIL_WIDTH, height), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def _gradient_energy(region: np.ndarray) -> float:
+    if region.shape[0] < 2 or region.shape[1] < 2:
+        return 0.0
+    return float(np.square(np.diff(region, axis=0)).mean() + np.square(np.diff(region, axis=1)).mean())
+
+
+def _blur_score(region: np.ndarray) -> float:
+    # A sharp edge keeps its squared-gradient energy when the image is halved; a blurred
+    # edge spreads over several pixels and loses most of it at the fine scale.
+    height, width = region.shape[0] // 2 * 2, region.shape[1] // 2 * 2
+    if height < 4 or width < 4:
+        return 0.0
+    fine = region[:height, :width]
+    coarse = fine.reshape(height // 2, 2, width // 2, 2).mean(axis=(1, 3))
+    coarse_energy = _gradient_energy(coarse)
+    if coarse_energy < 1e-4:
+        return 0.0  # Flat region, nothing to judge sharpness by.
+    ratio = _gradient_energy(fine) / coarse_energy
+    return float(np.clip((SHARP_ENERGY_RATIO - ratio) / (SHARP_ENERGY_RATIO / 2), 0.0, 1.0))
+
+
+def overlay_signals(gray: np.ndarray) -> Dict[str, float]:
+    """
+    Computes the visual signs of a modal on a grayscale thumbnail, each scaled to about [0, 1].
+
+    - scrim: the top band is dimmed relative to the brightest part of the screen.
+    - blur: the top band has lost its fine edge detail.
+    - card: a contiguous run of rows is bright in the center and dim at the edges.
+    - sheet: a sharp step in brightness separates a dim top from a bright bottom.
+    """
+    height, width = gray.shape
+    margin = max(1, int(height * SYSTEM_BAR_FRACTION))
+    body = gray[margin:height - margin]
+    body_height = body.shape[0]
+    if body_height < 10 or width < 10:
+        return {'scrim': 0.0, 'blur': 0.0, 'card': 0.0, 'sheet': 0.0}
+
+    top_band = body[:max(2, body_height // 6)]
+
+    screen_peak = float(np.percentile(body, 98))
+    top_peak = float(np.percentile(top_band, 98))
+    scrim = max(0.0, 1.0 - top_peak / screen_peak) if screen_peak > 0 else 0.0
+
+    blur = _blur_score(top_band)
+
+    side = max(1, width // 20)
+    center_columns = body[:, int(width * 0.2): int(width * 0.8)].mean(axis=1)
+    side_columns = np.concatenate([body[:, :side], body[:, -side:]], axis=1).mean(axis=1)
+    row_contrast = center_columns - side_columns
+    card_rows = row_contrast > CARD_ROW_CONTRAST
+    card = 0.0
+    longest, run = 0, 0
+    for is_card_row in card_rows:
+        run = run + 1 if is_card_row else 0
+        longest = max(longest, run)
+    if 0.1 <= longest / body_height <= 0.85:
+        card = min(1.0, float(row_contrast[card_rows].mean()) * 2)
+
+    rows = body.mean(axis=1)
+    splits = np.arange(max(2, int(body_height * 0.3)), int(body_height * 0.85))
+    cumulative = np.concatenate([[0.0], np.cumsum(rows)])
+    above = cumulative[splits] / splits
+    below = (cumulative[-1] - cumulative[splits]) / (body_height - splits)
+    step = (rows[splits] + rows[splits + 1] - rows[splits - 1] - rows[splits - 2]) / 2
+    sheet = float(np.clip(np.minimum(step, below - above) * 2, 0.0, 1.0).max()) if splits.size else 0.0
+
+    return {'scrim': round(scrim, 4), 'blur': round(blur, 4), 'card': round(card, 4), 'sheet': round(sheet, 4)}
+
+
+def classify_overlay(encoded_image: str, threshold: float = None, image_data: bytes = None) -> Dict[str, Any]:
+    """
+    Locally pre-classifies a screenshot before the vision LLM call.
+
+    Returns:
+        dict with 'verdict' ('no_popup' when confident there is no modal, otherwise 'ambiguous'),
+        the overall 'score' (strongest signal) and the individual 'signals'.
+    """
+    threshold = NO_POPUP_THRESHOLD if threshold is None else threshold
+    signals = overlay_signals(load_thumbnail(encoded_image, image_data))
+    score = max(signals.values())
+    return {
+        'verdict': 'no_popup' if score < threshold else 'ambiguous',
+        'score': round(score, 4),
+        'signals': signals,
+    }
@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from elements import element_metadata, parse_bounds
+from spatial_index import contains
+from logger_config import logger
+
+DEFAULT_SIGNATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "popup_signatures.json")
+
+
+def resource_package(resource_id: str) -> str:
+    """Package prefix of a resource-id like "com.android.permissioncontroller:id/permission_deny_button"."""
+    return resource_id.split(":id/", 1)[0] if ":id/" in resource_id else ""
+
+
+def resource_name(resource_id: str) -> str:
+    """Resource name suffix of a resource-id, in the ":id/<name>" form used by the signatures."""
+    return ":id/" + resource_id.split(":id/", 1)[1] if ":id/" in resource_id else ""
+
+
+class PopupSignature:
+    """
+    One known popup: what identifies it and its actions in order of preference. Actions marked
+    `"dismisses": false` (update, rate, open settings, grant) do not close the popup and are
+    only ever offered as alternates to a dismissal action.
+    """
+    __slots__ = ('name', 'description', 'text_patterns', 'actions', 'defer_keywords')
+
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.description = spec.get("description", spec["name"])
+        self.text_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in spec.get("require_any", {}).get("text_patterns", [])]
+        self.actions = []
+        for action in spec["actions"]:
+            self.actions.append({
+                "resource_id": action.get("resource_id"),
+                "text": re.compile(action["text"], re.IGNORECASE) if "text" in action else None,
+                "content_desc": re.compile(action["content_desc"], re.IGNORECASE) if "content_desc" in action else None,
+                "reason": action.get("reason", ""),
+                "dismisses": action.get("dismisses", True),
+            })
+        self.defer_keywords = [keyword.lower() for keyword in spec.get("defer_keywords", [])]
+
+    def action_for(self, element) -> Optional[Dict[str, Any]]:
+        """Returns the first action the element satisfies, or None."""
+        for action in self.actions:
+            if action["resource_id"] and resource_name(element.resource_id) == action["resource_id"]:
+                return action
+            if action["text"] and element.text and action["text"].fullmatch(element.text.strip()):
+                return action
+            if action["content_desc"] and element.content_desc and action["content_desc"].fullmatch(element.content_desc.strip()):
+                return action
+        return None
+
+
+class SignatureLibrary:
+    """
+    Indexed library of known popups, matched against extracted hierarchy elements.
+
+    Packages and resource names are looked up in dicts; all text patterns are compiled into
+    one alternation with a named group per signature, so each text is scanned once.
+    """
+
+    def __init__(self, specs: List[Dict[str, Any]]):
+        self.signatures = [PopupSignature(spec) for spec in specs]
+        self.by_package = {}
+        self.by_resource = {}
+        text_groups = []
+        for index, spec in enumerate(specs):
+            require_any = spec.get("require_any", {})
+            for package in require_any.get("packages", []):
+                self.by_package.setdefault(package, []).append(index)
+            for resource_id in require_any.get("resource_ids", []):
+                self.by_resource.setdefault(resource_id, []).append(index)
+            for pattern in require_any.get("text_patterns", []):
+                text_groups.append(f"(?P<s{index}_{len(text_groups)}>{pattern})")
+        self.text_index = re.compile("|".join(text_groups), re.IGNORECASE) if text_groups else None
+
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matched = 0
+        self.total_latency_s = 0.0
+        self.matches_by_signature = {signature.name: 0 for signature in self.signatures}
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_SIGNATURES_PATH):
+        with open(path, "r", encoding="utf-8") as signatures_file:
+            specs = json.load(signatures_file)
+        logger.info(f"Loaded {len(specs)} popup signatures from {path}")
+        return cls(specs)
+
+    def _candidates(self, elements, content) -> List[int]:
+        candidates = set()
+        for element in list(elements.values()) + list(content or []):
+            resource_id = element.resource_id
+            if resource_id:
+                candidates.update(self.by_package.get(resource_package(resource_id), ()))
+                candidates.update(self.by_resource.get(resource_name(resource_id), ()))
+            if self.text_index is not None:
+                for text in (element.text, element.content_desc):
+                    if text:
+                        for found in self.text_index.finditer(text):
+                            candidates.add(int(found.lastgroup[1:].split("_")[0]))
+        return sorted(candidates)
+
+    def match(self, elements, content=None, testcase_desc: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Matches the interactable elements (and optional context elements) against the library.
+        Both should be limited to the popup region (see `popup_region_elements`); a signature's
+        package, resource-id or text anchor has to be among them.
+
+        Returns:
+            dict with the signature 'name' and 'description', and 'primary' and 'alternates' as
+            lists of (element_id, reason), or None when no signature matches with a dismissal
+            element present, or when the test case asks for an action the signature defers to the LLM.
+        """
+        start_time = time.perf_counter()
+        result = None
+        testcase = (testcase_desc or "").lower()
+        for index in self._candidates(elements, content):
+            signature = self.signatures[index]
+            if any(keyword in testcase for keyword in signature.defer_keywords):
+                continue
+            ranked = []
+            for element_id, element in elements.items():
+                action = signature.action_for(element)
+                if action is not None:
+                    ranked.append((signature.actions.index(action), element_id, action["reason"], action["dismisses"]))
+            # Without a dismissal element (say only "Update" or "Rate now"), the LLM decides.
+            if not any(item[3] for item in ranked):
+                continue
+            ranked.sort(key=lambda item: (not item[3], item[0]))
+            result = {
+                "name": signature.name,
+                "description": signature.description,
+                "primary": (ranked[0][1], ranked[0][2]),
+                "alternates": [(element_id, reason) for _, element_id, reason, _ in ranked[1:]],
+            }
+            break
+
+        with self._lock:
+            self.lookups += 1
+            self.total_latency_s += time.perf_counter() - start_time
+            if result is not None:
+                self.matched += 1
+                self.matches_by_signature[result["name"]] += 1
+        return result
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "matched": self.matched,
+                "match_rate": round(self.matched / self.lookups, 4) if self.lookups else 0.0,
+                "mean_latency_ms": round(self.total_latency_s / self.lookups * 1000, 4) if self.lookups else 0.0,
+                "matches_by_signature": dict(self.matches_by_signature),
+            }
+
+
+def popup_region_elements(processed_xml):
+    """
+    Restricts the extracted hierarchy to the detected popup region for signature matching.
+
+    Returns:
+        (elements, content): the interactable elements listed in details['overlay_element_ids']
+        and the context elements inside the popup bounds, or None when the rule-based detector
+        found no popup region. Matching is never done against the whole screen, where ordinary
+        rows and links ("Rate us", "Cookie policy", a toolbar's "Navigate up") would match.
+    """
+    if not processed_xml or not processed_xml.get("is_popup"):
+        return None
+    details = processed_xml.get("details", {})
+    overlay_ids = details.get("overlay_element_ids")
+    region = parse_bounds(details.get("bounds", ""))
+    if not overlay_ids or region is None:
+        return None
+    interactable = processed_xml.get("interactable_elements", {})
+    elements = {element_id: interactable[element_id] for element_id in overlay_ids if element_id in interactable}
+    content = [element for element in processed_xml.get("content", []) if element.rect is not None and contains(region, element.rect)]
+    return elements, content
+
+
+def signature_response(match, elements) -> Dict[str, Any]:
+    """Renders a signature match in the same shape as the LLM-backed responses."""
+    primary_id, primary_reason = match["primary"]
+    primary = elements[primary_id]
+    label = (primary.text or primary.content_desc or primary.resource_id).strip()
+    return {
+        "status": "success",
+        "message": "success",
+        "agent_response": {
+            "popup_detection": True,
+            "suggested_action": f"Tap \"{label}\" on the {match['description'].lower()}",
+            "primary_method": {
+                "selection_reason": primary_reason,
+                "element_metadata": element_metadata(elements, primary_id)
+            },
+            "alternative_methods": [
+                {
+                    "element_metadata": element_metadata(elements, element_id),
+                    "dismissal_reason": reason
+                }
+                for element_id, reason in match["alternates"]
+            ]
+        },
+        "resolved_by": "signature",
+        "signature": match["name"]
+    }
+
+
+# Loaded once at startup; POPUP_SIGNATURES_PATH points at an alternative library.
+signature_library = SignatureLibrary.load(os.getenv("POPUP_SIGNATURES_PATH", DEFAULT_SIGNATURES_PATH))
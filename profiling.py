@@ -0,0 +1,66 @@
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict
+
+# tracemalloc is process-wide; it runs while at least one profiled request is in flight.
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+
+
+def _start_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+class StageProfiler:
+    """
+    Records per-stage wall-clock timings of a request and, when `trace_memory` is set, the
+    tracemalloc peak of each stage.
+
+    Memory peaks are process-wide, so concurrent requests inflate each other's numbers; use
+    them for capacity planning under controlled load rather than as exact per-request figures.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.timings_ms = {}
+        self.peak_memory_kb = {}
+        if trace_memory:
+            _start_tracing()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory, _ = tracemalloc.get_traced_memory()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings_ms[name] = round((time.perf_counter() - start_time) * 1000, 2)
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                self.peak_memory_kb[name] = round(max(0, peak - start_memory) / 1024, 1)
+
+    def report(self) -> Dict[str, Any]:
+        """Stops memory tracing for this request and returns the fields added to the response."""
+        report = {"stage_timings_ms": dict(self.timings_ms)}
+        if self.trace_memory:
+            _stop_tracing()
+            self.trace_memory = False
+            report["stage_peak_memory_kb"] = dict(self.peak_memory_kb)
+            report["peak_memory_kb"] = max(self.peak_memory_kb.values(), default=0.0)
+        return report
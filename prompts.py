@@ -51,6 +51,8 @@ Include the element metadata that the execution agent has to act on, ensuring cl
 
 Additionally, provide the hierarchical XPath for the element to act on.
 
+When the detector output details include `overlay_element_ids`, those are the elements inside the detected pop-up region; elements hidden behind the pop-up have already been removed. `close_icon_id`, if present, is the small element nearest the pop-up's top-right corner, where close icons usually sit.
+
 Ensure that your analysis is thorough and your recommendations are clear and precise.
 
 Please respond in the following format:
@@ -120,6 +122,92 @@ Return your output in the following JSON format:
   ]
 }
 
-Test case description: {testcase_desc}
 The annotated screenshot includes bounding boxes with element IDs for all interactable elements.
 """
+
+
+# Fixed input descriptions appended to the system prompts. Together they form a
+# byte-identical static prefix ahead of all per-request content, so that repeated
+# calls can reuse OpenAI's cached prompt prefix.
+
+image_input_schema = """
+Input format:
+1. A message "Test case description: <text>" describing the test step being executed.
+2. A message containing the text "Screenshot of current screen" followed by the screenshot as an image.
+Only the JSON object described above must be returned, with no surrounding prose.
+"""
+
+xml_input_schema = """
+Input format:
+1. A message "Test case description: <text>" describing the test step being executed.
+2. A message "Pop-up detector output:" followed by the detector output in this line-based layout:
+   is_popup: True or False, as decided by the rule-based detector
+   details: width, height, center_x, center_y and bounds of the detected pop-up region, plus optional hints:
+     overlay_element_ids - ids of the elements inside the pop-up region
+     occluded_count - number of elements hidden behind the pop-up
+     close_icon_id - id of the small element nearest the pop-up's top-right corner
+   changes since previous screen: present only when an earlier screen of the same run was seen; bounds of the region that changed and the number of added, removed and changed subtrees. A newly added region is a strong sign of a pop-up.
+   content: one line per non-clickable element, either
+     text '<visible text>'
+     image resource_id=<id> content_desc='<description>' bounds=[x1,y1][x2,y2]
+   interactable_elements: one line per clickable element
+     _id=<id> type=<widget class> text='<text>' resource_id=<id> content_desc='<description>' bounds=[x1,y1][x2,y2] xpath=<xpath>
+     Empty fields are omitted. Boolean flags (focused, scrollable, long_clickable, password, selected) are listed only when true, and enabled=false only when the element is disabled.
+Only the `_id` values listed under interactable_elements may be returned, and only the JSON object described above must be returned, with no surrounding prose.
+"""
+
+combined_input_schema = """
+Input format:
+1. A message "Test case description: <text>" describing the test step being executed.
+2. A message containing the text "Screenshot of current screen with annotated element IDs" followed by the annotated screenshot as an image.
+   Each interactable element is outlined with a red rectangle and labelled with its element ID in red just above its top-left corner.
+Only element IDs visible as labels in the screenshot may be returned, and only the JSON object described above must be returned, with no surrounding prose.
+"""
+
+cropped_combined_input_schema = """
+Input format:
+1. A message "Test case description: <text>" describing the test step being executed.
+2. A message containing the text "Close-up of the detected pop-up region with annotated element IDs" followed by a high-detail crop of the screen around the pop-up.
+   Each interactable element inside the crop is outlined with a red rectangle and labelled with its element ID in red just above its top-left corner.
+3. A message containing the text "Whole screen for context" followed by a low-detail thumbnail of the full screen, without annotations.
+Decide on pop-up presence using both images. Only element IDs visible as labels in the close-up may be returned, and only the JSON object described above must be returned, with no surrounding prose.
+"""
+
+
+# Selection guidance and worked examples shared by all prompts. They are part of the static
+# prefix as well; OpenAI only caches prefixes of at least 1024 tokens, and the system prompt
+# plus input schema alone fall short of that.
+
+dismissal_guidelines = """
+Guidelines for choosing the element to act on:
+1. The test case description takes priority. If it asks for a specific outcome (for example "allow location access", "accept cookies" or "rate the app"), choose the element that produces that outcome, even if another element would close the pop-up more quickly.
+2. Otherwise the goal is to get the pop-up out of the way with the fewest side effects, so the test can continue on the screen underneath. Prefer, in order:
+   a. An explicit close control: an "X" icon, "Close", "Dismiss" or "Done", usually near the top-right corner of the pop-up.
+   b. A neutral or negative answer that closes the pop-up: "Not now", "No thanks", "Maybe later", "Skip", "Cancel", "Deny", "Don't allow", "Reject all", "Decline".
+   c. A positive answer, only when no neutral option exists and the action is harmless, such as "OK" or "Got it" on an informational message.
+3. Avoid elements that leave the app under test or start a new flow: store links, "Update", "Install", "Subscribe", "Upgrade", "Buy", "Sign in", "Share", "Rate now", external links and settings shortcuts.
+4. Never choose an element that confirms a purchase, payment, deletion, sign-out or any irreversible change, unless the test case description explicitly asks for it.
+5. Elements of the screen behind the pop-up are not valid choices while the pop-up is shown. Only choose elements that belong to the pop-up itself.
+6. Persistent screen chrome such as navigation bars, toolbars, tab bars and floating action buttons is part of the screen, not a pop-up. Prompts that ask the user for a decision are pop-ups even without a dimmed background, including cookie or consent banners docked to the bottom of the screen, permission requests, rating prompts and update prompts.
+7. When several pop-ups are stacked, act on the topmost one only.
+8. Keep suggested_action to a single imperative sentence naming the element, for example "Tap the close icon" or "Tap 'Not now'".
+9. List up to three alternate elements that would also affect the pop-up, most plausible first, each with a short reason why it was not chosen. Use an empty list when there are none.
+"""
+
+image_examples = """
+Example: a screenshot shows a dimmed app screen with a centered white card titled "Turn on notifications" and two buttons, "Allow" on the right and "Not now" on the left, and a small "X" icon in the card's top-right corner. The test case description is "close the pop up".
+A good answer chooses the "X" icon as the primary element, describing it as the small X icon at the top-right corner of the centered white card, because it closes the pop-up without changing any setting. "Not now" is the first alternate, closing the pop-up while declining notifications, and "Allow" is the second alternate, rejected because it grants a permission the test did not ask for.
+Example: a screenshot shows a list of products with a bottom navigation bar and a green floating action button. There is no dimmed background and nothing blocks the content. The answer is that no pop-up is present.
+"""
+
+xml_examples = """
+Example: the detector output has is_popup: True, details with overlay_element_ids 4, 5 and 6 and close_icon_id 6, and interactable elements 4 (text 'Allow'), 5 (text 'Not now') and 6 (content_desc 'Close', a small image button at the top-right of the pop-up region). The test case description is "close the pop up".
+A good answer chooses _id 6 as the primary element because it closes the pop-up without changing any setting, with 5 as the first alternate (closes the pop-up while declining) and 4 as the second alternate (grants a permission the test did not ask for).
+Example: the detector output has is_popup: False, no overlay hints, and interactable elements that are ordinary list rows, tabs of a bottom navigation bar and a search field. The answer is that no pop-up is present, even though some elements such as the navigation bar are drawn on top of the list.
+"""
+
+combined_examples = """
+Example: the annotated screenshot shows a dimmed app screen with a centered card titled "Turn on notifications". Inside the card, element 5 is labelled on a "Not now" button, element 4 on an "Allow" button and element 6 on a small "X" icon in the card's top-right corner. Elements 1 to 3 are labelled on the dimmed screen behind the card. The test case description is "close the pop up".
+A good answer chooses element 6 as the primary element because it closes the pop-up without changing any setting, with 5 as the first alternate (closes the pop-up while declining) and 4 as the second alternate (grants a permission the test did not ask for). Elements 1 to 3 are behind the pop-up and are not valid choices.
+Example: the annotated screenshot shows a list of products with a bottom navigation bar whose tabs are labelled 7 to 10, and no dimmed background. The answer is that no pop-up is present.
+"""
@@ -0,0 +1,91 @@
+"""
+Replays recorded /invoke traffic against the current code with recorded LLM completions.
+
+Record a session first by running the service with LLM_REPLAY_MODE=record, then:
+
+    python replay_benchmark.py --dir llm_recordings --concurrency 4
+
+No OpenAI calls or network access are made; requests whose prompts changed since the
+recording show up as replay misses.
+
+Prompts of a run depend on the earlier hierarchies of the same run (see xml_diff.py), so
+requests sharing a run_id are replayed one after another in recorded order, and the
+per-run hierarchy cache is cleared before every pass.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def group_by_run(payloads):
+    """Splits payloads into sequences that must run in order: one per run_id, one per request without."""
+    sequences = {}
+    for index, payload in enumerate(payloads):
+        sequences.setdefault(payload.get("run_id") or f"request-{index}", []).append(payload)
+    return list(sequences.values())
+
+
+async def replay(requests_path, concurrency, repeat):
+    # Imported after LLM_REPLAY_MODE is set so the service starts in replay mode.
+    from main import APIRequest, run_service
+    from xml_diff import hierarchy_cache
+
+    with open(requests_path, "r", encoding="utf-8") as requests_file:
+        payloads = [json.loads(line) for line in requests_file if line.strip()]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def run_sequence(sequence):
+        async with semaphore:
+            for payload in sequence:
+                start_time = time.perf_counter()
+                response = await asyncio.to_thread(asyncio.run, run_service(APIRequest(**payload)))
+                latencies.append(time.perf_counter() - start_time)
+                if response.get("status") == "error":
+                    errors.append(response.get("details") or response.get("message"))
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        hierarchy_cache.clear()
+        await asyncio.gather(*(run_sequence(sequence) for sequence in group_by_run(payloads)))
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "requests": len(payloads) * repeat,
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(payloads) * repeat / elapsed, 2) if elapsed else 0.0,
+        "latency_mean_ms": round(statistics.mean(latencies) * 1000, 2) if latencies else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "sample_errors": errors[:5],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default="llm_recordings", help="Recording directory")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the recorded traffic this many times")
+    args = parser.parse_args()
+
+    os.environ["LLM_REPLAY_MODE"] = "replay"
+    os.environ["LLM_REPLAY_DIR"] = args.dir
+    report = asyncio.run(replay(os.path.join(args.dir, "requests.jsonl"), args.concurrency, args.repeat))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
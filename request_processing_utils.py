@@ -1,20 +1,45 @@
 from typing import Any
-from prompts import image_prompt, combined_prompt, xml_prompt
+from collections import OrderedDict
+from prompts import image_prompt, combined_prompt, xml_prompt, image_input_schema, combined_input_schema, cropped_combined_input_schema, xml_input_schema, dismissal_guidelines, image_examples, xml_examples, combined_examples
 from logger_config import logger
 from fastapi import HTTPException
+import hashlib
 import json
 import os
+import threading
 from llm import initialize_llm
-from utils import annotate_image_using_actionable_elements, process_actionable_elements
+from llm_replay import PASSTHROUGH, REPLAY, RecordReplayLLM
+from overlay_detector import classify_overlay
+from deadline import hedged_invoke
+from utils import annotate_image_using_actionable_elements, annotate_popup_crop, process_actionable_elements
+from elements import element_metadata, popup_details_to_prompt
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
+# LLM_REPLAY_MODE is one of passthrough (default), record or replay; see llm_replay.py.
+llm_replay_mode = os.getenv("LLM_REPLAY_MODE", PASSTHROUGH)
 llm_key = os.getenv("OPENAI_API_KEY")
-if not llm_key:
+if not llm_key and llm_replay_mode != REPLAY:
     raise HTTPException(status_code=500, detail="API key not found. Please check your environment variables.")
-llm = initialize_llm(llm_key)
+llm = RecordReplayLLM(
+    initialize_llm(llm_key) if llm_key else None,
+    mode=llm_replay_mode,
+    directory=os.getenv("LLM_REPLAY_DIR", "llm_recordings")
+)
+# Calls made under a deadline use a client without retries and get the remaining budget as
+# their timeout, so calls abandoned at the deadline free their executor thread soon after.
+deadline_llm = RecordReplayLLM(
+    initialize_llm(llm_key, max_retries=0) if llm_key else None,
+    mode=llm_replay_mode,
+    directory=os.getenv("LLM_REPLAY_DIR", "llm_recordings")
+)
+
+# Off by default: the threshold has only been checked on synthetic screens. Enable it after
+# calibrating OVERLAY_NO_POPUP_THRESHOLD with overlay_benchmark.py on real labelled screenshots.
+overlay_detector_enabled = os.getenv("OVERLAY_DETECTOR_ENABLED", "false").lower() == "true"
+roi_cropping_enabled = os.getenv("ROI_CROPPING_ENABLED", "true").lower() == "true"
 
 def clean_markdown_json(content):
     if content.startswith("```json\n"):
@@ -34,9 +59,67 @@ def clean_markdown_json(content):
     return content
 
 
-def trigger_llm(messages) -> dict[Any, Any]:
-    ai_msg = llm.invoke(messages)
+def build_static_prefix(system_prompt, input_schema, examples):
+    sections = (system_prompt, input_schema, dismissal_guidelines, examples)
+    return ("system", "\n\n".join(section.strip() for section in sections))
+
+# Built once at import so every request sends a byte-identical prefix. OpenAI caches
+# prefixes only from 1024 tokens up, which the guidelines and examples get each prefix past.
+IMAGE_PREFIX = build_static_prefix(image_prompt, image_input_schema, image_examples)
+XML_PREFIX = build_static_prefix(xml_prompt, xml_input_schema, xml_examples)
+COMBINED_PREFIX = build_static_prefix(combined_prompt, combined_input_schema, combined_examples)
+CROPPED_COMBINED_PREFIX = build_static_prefix(combined_prompt, cropped_combined_input_schema, combined_examples)
+
+
+def build_messages(static_prefix, testcase_desc, *contents):
+    """
+    Builds the message list for an LLM call.
+
+    The static prefix (system prompt plus input schema) always comes first and nothing
+    request-specific is interpolated into it, so OpenAI's automatic prompt-prefix
+    caching can reuse it across calls. Per-request content follows in a fixed order.
+    """
+    messages = [static_prefix, ("human", f"Test case description: {testcase_desc}")]
+    for content in contents:
+        messages.append(("human", content))
+    return messages
+
+
+def image_content(caption, encoded_image, detail=None):
+    image_url = {"url": f"data:image/jpeg;base64,{encoded_image}"}
+    if detail:
+        image_url["detail"] = detail
+    return [
+        {"type": "text", "text": caption},
+        {"type": "image_url", "image_url": image_url}
+    ]
+
+
+def extract_usage(ai_msg) -> dict[str, int]:
+    usage = getattr(ai_msg, "usage_metadata", None) or {}
+    input_token_details = usage.get("input_token_details") or {}
+    return {
+        "input_tokens": usage.get("input_tokens", 0),
+        "cached_tokens": input_token_details.get("cache_read", 0) or 0,
+        "output_tokens": usage.get("output_tokens", 0),
+    }
+
+
+def trigger_llm(messages, deadline=None) -> tuple[dict[Any, Any], dict[str, int], str]:
+    """
+    Calls the LLM and parses its JSON answer.
+
+    Returns:
+        (parsed_output, usage, resolved_by) where resolved_by is "llm", or "llm_hedge" when a
+        hedged duplicate request fired near the deadline answered first.
+    """
+    if deadline is not None:
+        ai_msg, hedged = hedged_invoke(deadline_llm, messages, deadline)
+    else:
+        ai_msg, hedged = llm.invoke(messages), False
     logger.info(f"AI message: {str(ai_msg.content)}")
+    usage = extract_usage(ai_msg)
+    logger.info(f"LLM usage: {usage}")
 
     # Clean and parse the AI response
     cleaned_content = clean_markdown_json(ai_msg.content)
@@ -47,38 +130,53 @@ def trigger_llm(messages) -> dict[Any, Any]:
         parsed_output = {}
     logger.info(f"Parsed output: {parsed_output}")
 
-    return parsed_output
+    return parsed_output, usage, "llm_hedge" if hedged else "llm"
 
 
-def process_request_with_image_only(request, encoded_image):
-    messages = [
-        ("system", image_prompt),
-        ("human", f"Test case description: {request.testcase_desc}"),
-        ("human", [
-            {"type": "text", "text": "Screenshot of current screen"},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
-        ])
-    ]
+def process_request_with_image_only(request, encoded_image, deadline=None, image_data=None):
+    # Most screens have no popup; answer those locally and only send ambiguous ones to the LLM.
+    if overlay_detector_enabled:
+        try:
+            overlay = classify_overlay(encoded_image, image_data=image_data)
+            logger.info(f"Local overlay detector: {overlay}")
+            if overlay["verdict"] == "no_popup":
+                return {
+                    "status": "success",
+                    "message": "success",
+                    "agent_response": {"popup_detection": False},
+                    "resolved_by": "overlay_detector",
+                    "overlay_score": overlay["score"]
+                }
+        except Exception as e:
+            logger.error(f"Local overlay detector failed, falling back to the LLM: {e}")
+
+    messages = build_messages(
+        IMAGE_PREFIX,
+        request.testcase_desc,
+        image_content("Screenshot of current screen", encoded_image)
+    )
 
-    parsed_output = trigger_llm(messages=messages)
+    parsed_output, usage, resolved_by = trigger_llm(messages=messages, deadline=deadline)
 
     # Image-only case: Return parsed output directly
     final_response = {
         "status": "success",
         "message": "success",
-        "agent_response": parsed_output
+        "agent_response": parsed_output,
+        "llm_usage": usage,
+        "resolved_by": resolved_by
     }
 
     return final_response
 
-def process_request_with_xml_only(request, processed_xml):
-    messages = [
-        ("system", xml_prompt),
-        ("human", f"Test case description: {request.testcase_desc}"),
-        ("human", f"Pop-up detector output: {processed_xml}")
-    ]
+def process_request_with_xml_only(request, processed_xml, deadline=None):
+    messages = build_messages(
+        XML_PREFIX,
+        request.testcase_desc,
+        f"Pop-up detector output:\n{popup_details_to_prompt(processed_xml)}"
+    )
 
-    parsed_output = trigger_llm(messages=messages)
+    parsed_output, usage, resolved_by = trigger_llm(messages=messages, deadline=deadline)
 
     # XML-only case: Check processed_xml for popup detection
     if not processed_xml.get("is_popup", False):
@@ -89,7 +187,7 @@ def process_request_with_xml_only(request, processed_xml):
             primary_method_ai = parsed_output.get("primary_method", {})
             primary_id = primary_method_ai.get("_id", "")
             primary_selection_reason = primary_method_ai.get("selection_reason", "")
-            primary_metadata = processed_xml.get("interactable_elements", {}).get(primary_id, {})
+            primary_metadata = element_metadata(processed_xml.get("interactable_elements", {}), primary_id)
             
             # Alternative methods mapping
             alternative_methods_ai = parsed_output.get("alternate_methods", [])
@@ -97,7 +195,7 @@ def process_request_with_xml_only(request, processed_xml):
             for method in alternative_methods_ai:
                 alt_id = method.get("_id", "")
                 alt_dismissal_reason = method.get("dismissal_reason", "")
-                alt_metadata = processed_xml.get("interactable_elements", {}).get(alt_id, {})
+                alt_metadata = element_metadata(processed_xml.get("interactable_elements", {}), alt_id)
                 if alt_metadata:
                     alternative_methods_mapped.append({
                         "element_metadata": alt_metadata,
@@ -132,22 +230,39 @@ def process_request_with_xml_only(request, processed_xml):
                 }
             } 
 
+    final_response["llm_usage"] = usage
+    final_response["resolved_by"] = resolved_by
     return final_response
 
-def process_request_with_image_and_actionable_elements(testcase_desc, actionable_element_dict, encoded_image):
+def process_request_with_image_and_actionable_elements(testcase_desc, actionable_element_dict, encoded_image, deadline=None, popup_region=None, image_data=None):
     logger.info("Both image and actionable elements provided")
     logger.debug(f"Number of actionable elements: {len(actionable_element_dict.values())}")
-    annotated_image = annotate_image_using_actionable_elements(base64_image=encoded_image, actionable_element_dict=actionable_element_dict)
-    messages = [
-        ("system", combined_prompt),
-        ("human", f"Test case description: {testcase_desc}"),
-        ("human", [
-            {"type": "text", "text": "Screenshot of current screen with annotated element IDs"},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{annotated_image}"}}
-        ])
-    ]
+    if deadline is not None:
+        deadline.check("annotation")
+
+    # With a known popup region, send a high-detail close-up plus a low-detail thumbnail
+    # instead of the full annotated screen.
+    cropped = None
+    if roi_cropping_enabled and popup_region is not None:
+        cropped = annotate_popup_crop(base64_image=encoded_image, actionable_element_dict=actionable_element_dict, region=popup_region, image_data=image_data)
+    if cropped is not None:
+        annotated_crop, thumbnail, crop_box = cropped
+        logger.info(f"Sending popup crop {crop_box} with a context thumbnail")
+        messages = build_messages(
+            CROPPED_COMBINED_PREFIX,
+            testcase_desc,
+            image_content("Close-up of the detected pop-up region with annotated element IDs", annotated_crop, detail="high"),
+            image_content("Whole screen for context", thumbnail, detail="low")
+        )
+    else:
+        annotated_image = annotate_image_using_actionable_elements(base64_image=encoded_image, actionable_element_dict=actionable_element_dict, image_data=image_data)
+        messages = build_messages(
+            COMBINED_PREFIX,
+            testcase_desc,
+            image_content("Screenshot of current screen with annotated element IDs", annotated_image)
+        )
 
-    parsed_output = trigger_llm(messages=messages)
+    parsed_output, usage, resolved_by = trigger_llm(messages=messages, deadline=deadline)
 
     # Combined case: Trust LLM's popup detection from image analysis
     if parsed_output.get("popup_detection", True) == False:
@@ -158,7 +273,7 @@ def process_request_with_image_and_actionable_elements(testcase_desc, actionable
             primary_method_ai = parsed_output.get("primary_method", {})
             primary_id = primary_method_ai.get("_id", "")
             primary_selection_reason = primary_method_ai.get("selection_reason", "")
-            primary_metadata = actionable_element_dict.get(primary_id, {})
+            primary_metadata = element_metadata(actionable_element_dict, primary_id)
             
             # Map alternative methods
             alternative_methods_ai = parsed_output.get("alternate_methods", [])
@@ -166,7 +281,7 @@ def process_request_with_image_and_actionable_elements(testcase_desc, actionable
             for method in alternative_methods_ai:
                 alt_id = method.get("_id", "")
                 alt_dismissal_reason = method.get("dismissal_reason", "")
-                alt_metadata = actionable_element_dict.get(alt_id, {})
+                alt_metadata = element_metadata(actionable_element_dict, alt_id)
                 if alt_metadata:
                     alternative_methods_mapped.append({
                         "element_metadata": alt_metadata,
@@ -200,4 +315,125 @@ def process_request_with_image_and_actionable_elements(testcase_desc, actionable
                 }
             } 
     
+    final_response["llm_usage"] = usage
+    final_response["resolved_by"] = resolved_by
     return final_response
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU of recent LLM answers, served as a fallback when a deadline runs out.
+
+    Answers are stored and returned as copies without the fields that describe the request
+    that produced them, since callers go on to add their own.
+    """
+
+    PER_REQUEST_FIELDS = ("request_id", "llm_usage", "stage_timings_ms", "stage_peak_memory_kb", "peak_memory_kb", "deadline_exceeded")
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            response = self._entries.get(key)
+            if response is None:
+                return None
+            self._entries.move_to_end(key)
+            return dict(response)
+
+    def put(self, key, response):
+        response = {field: value for field, value in response.items() if field not in self.PER_REQUEST_FIELDS}
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache()
+
+
+def response_cache_key(request) -> str:
+    """Hashes the inputs that determine an answer: test case, screen inputs and actionable elements."""
+    digest = hashlib.sha256()
+    for part in (request.testcase_desc, request.xml or request.xml_url or "", request.image or request.image_url or ""):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    if request.actionable_elements:
+        digest.update(json.dumps(request.actionable_elements, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# Texts of elements that typically dismiss a popup, used by the XML heuristic fallback.
+DISMISS_TEXTS = ("close", "cancel", "not now", "no thanks", "no, thanks", "skip", "dismiss", "later", "maybe later", "don't allow", "deny", "got it", "ok")
+
+
+def xml_heuristic_response(processed_xml) -> dict[str, Any]:
+    """
+    Builds an answer from the rule-based XML detector alone, without the LLM.
+
+    The primary element is the close icon found near the popup's top-right corner, or else
+    the first element inside the popup whose text or description reads like a dismissal.
+    """
+    if not processed_xml.get("is_popup", False):
+        return {"popup_detection": False}
+
+    elements = processed_xml.get("interactable_elements", {})
+    details = processed_xml.get("details", {})
+    candidate_ids = details.get("overlay_element_ids") or list(elements)
+    primary_id = details.get("close_icon_id")
+    if primary_id is None:
+        for element_id in candidate_ids:
+            element = elements.get(element_id)
+            label = f"{element.text} {element.content_desc}".strip().lower() if element else ""
+            if label in DISMISS_TEXTS:
+                primary_id = element_id
+                break
+
+    alternative_methods = [
+        {
+            "element_metadata": element_metadata(elements, element_id),
+            "dismissal_reason": "Heuristic candidate inside the popup region"
+        }
+        for element_id in candidate_ids if element_id != primary_id and element_id in elements
+    ][:3]
+    return {
+        "popup_detection": True,
+        "suggested_action": "Tap the dismiss element of the popup" if primary_id else "",
+        "primary_method": {
+            "selection_reason": "Selected by the XML heuristic without the LLM",
+            "element_metadata": element_metadata(elements, primary_id)
+        } if primary_id else {},
+        "alternative_methods": alternative_methods
+    }
+
+
+def fallback_response(request, processed_xml, stage) -> dict[str, Any]:
+    """
+    Best cheap answer once a request's deadline has run out: a cached LLM answer for the
+    same inputs, else the XML heuristic, else an error. `resolved_by` names the source.
+
+    The heuristic is only used when the XML was actually parsed; an XML that failed to fetch
+    or parse would otherwise come back as a confident "no popup".
+    """
+    logger.warning(f"Deadline exceeded during {stage}, falling back to a cheap answer")
+    cached = response_cache.get(response_cache_key(request))
+    if cached is not None:
+        return {**cached, "resolved_by": "cache", "deadline_exceeded": stage}
+    if processed_xml and "error" not in processed_xml:
+        return {
+            "status": "success",
+            "message": "success",
+            "agent_response": xml_heuristic_response(processed_xml),
+            "resolved_by": "xml_heuristic",
+            "deadline_exceeded": stage
+        }
+    return {
+        "status": "error",
+        "message": f"Deadline exceeded during {stage} and no fallback answer is available.",
+        "code": 504,
+        "resolved_by": "none",
+        "deadline_exceeded": stage
+    }
@@ -0,0 +1,263 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from elements import Rect, parse_bounds
+
+# Class names and resource-id fragments that identify an overlay container outright.
+OVERLAY_CLASSES = (
+    'android.app.Dialog',
+    'android.widget.PopupWindow',
+    'androidx.appcompat.app.AlertDialog',
+)
+OVERLAY_RESOURCE_HINTS = ('dialog', 'popup', 'bottom_sheet', 'bottomsheet', 'parentPanel', 'alertTitle')
+
+# An overlay must cover between these fractions of the screen.
+MIN_OVERLAY_AREA_RATIO = 0.02
+MAX_OVERLAY_AREA_RATIO = 0.95
+
+# How much of an earlier clickable a container must cover for it to count as occluded.
+MIN_OCCLUSION_RATIO = 0.5
+
+# Containers spanning this fraction of the screen width and touching the top or bottom edge
+# (within the tolerance, in pixels) are treated as persistent chrome such as toolbars and nav bars.
+DOCKED_WIDTH_RATIO = 0.95
+DOCKED_EDGE_TOLERANCE = 8
+
+
+def rect_area(rect: Rect) -> int:
+    x1, y1, x2, y2 = rect
+    return max(0, x2 - x1) * max(0, y2 - y1)
+
+
+def intersection_area(a: Rect, b: Rect) -> int:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0
+    return width * height
+
+
+def contains(outer: Rect, inner: Rect) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+class SpatialIndex:
+    """
+    Uniform grid over rectangles keyed by arbitrary hashable keys.
+
+    Each rect is registered in every cell it overlaps, so region queries only look
+    at the cells the region touches instead of scanning every element.
+    """
+
+    def __init__(self, cell_size: int = 256):
+        self.cell_size = cell_size
+        self.rects: Dict[Any, Rect] = {}
+        self._cells: Dict[Tuple[int, int], List[Any]] = {}
+
+    def _cell_range(self, rect: Rect):
+        size = self.cell_size
+        x1, y1, x2, y2 = rect
+        for cx in range(x1 // size, max(x1, x2 - 1) // size + 1):
+            for cy in range(y1 // size, max(y1, y2 - 1) // size + 1):
+                yield (cx, cy)
+
+    def insert(self, key, rect: Optional[Rect]):
+        if rect is None:
+            return
+        self.rects[key] = rect
+        for cell in self._cell_range(rect):
+            self._cells.setdefault(cell, []).append(key)
+
+    def _candidates(self, region: Rect):
+        seen = set()
+        for cell in self._cell_range(region):
+            for key in self._cells.get(cell, ()):
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def intersecting(self, region: Rect) -> List[Any]:
+        """Returns keys whose rects overlap `region`."""
+        return [key for key in self._candidates(region) if intersection_area(self.rects[key], region) > 0]
+
+    def contained_in(self, region: Rect) -> List[Any]:
+        """Returns keys whose rects lie entirely inside `region`."""
+        return [key for key in self._candidates(region) if contains(region, self.rects[key])]
+
+    def nearest(self, point: Tuple[int, int], radius: int, keys: Optional[Iterable[Any]] = None):
+        """
+        Returns the key whose rect center is closest to `point` within `radius`, or None.
+
+        Args:
+            point: (x, y) in screen pixels
+            radius: maximum center distance in pixels
+            keys: optional subset of keys to consider
+        """
+        x, y = point
+        region = (x - radius, y - radius, x + radius, y + radius)
+        allowed = set(keys) if keys is not None else None
+        best_key, best_distance = None, None
+        for key in self._candidates(region):
+            if allowed is not None and key not in allowed:
+                continue
+            x1, y1, x2, y2 = self.rects[key]
+            distance = ((x1 + x2) / 2 - x) ** 2 + ((y1 + y2) / 2 - y) ** 2
+            if distance <= radius * radius and (best_distance is None or distance < best_distance):
+                best_key, best_distance = key, distance
+        return best_key
+
+
+class HierarchyIndex:
+    """
+    Spatial index over every node of a parsed XML hierarchy.
+
+    Nodes are keyed by their pre-order position, which is also their z-order: a node
+    later in document order is drawn on top of earlier ones. `subtree_end[i]` is the
+    position of the last descendant of node i, so ancestry checks are O(1).
+    """
+
+    def __init__(self, root, cell_size: int = 256):
+        self.nodes = []
+        self.order = {}
+        self.subtree_end = []
+        self.parent = []
+        self.index = SpatialIndex(cell_size)
+        self.clickable = set()
+        self._number(root)
+
+    def _number(self, root):
+        stack = [(root, False, -1)]
+        while stack:
+            node, done, parent = stack.pop()
+            if done:
+                self.subtree_end[self.order[node]] = len(self.nodes) - 1
+                continue
+            position = len(self.nodes)
+            self.order[node] = position
+            self.nodes.append(node)
+            self.subtree_end.append(position)
+            self.parent.append(parent)
+            self.index.insert(position, parse_bounds(node.get('bounds', '')))
+            if node.get('clickable', 'false') == 'true':
+                self.clickable.add(position)
+            stack.append((node, True, parent))
+            stack.extend((child, False, position) for child in reversed(list(node)))
+
+    def is_descendant(self, position: int, ancestor: int) -> bool:
+        return ancestor < position <= self.subtree_end[ancestor]
+
+    def rect(self, position: int) -> Optional[Rect]:
+        return self.index.rects.get(position)
+
+    def occluded_by(self, overlay: int) -> List[int]:
+        """
+        Returns clickable nodes drawn below `overlay` that it covers by at least
+        MIN_OCCLUSION_RATIO of their area. Ancestors and descendants are excluded.
+        """
+        region = self.rect(overlay)
+        if region is None:
+            return []
+        occluded = []
+        for position in self.index.intersecting(region):
+            if position >= overlay or position not in self.clickable:
+                continue
+            if self.is_descendant(overlay, position):
+                continue
+            rect = self.rect(position)
+            area = rect_area(rect)
+            if area and intersection_area(rect, region) / area >= MIN_OCCLUSION_RATIO:
+                occluded.append(position)
+        return occluded
+
+    def inside(self, overlay: int) -> List[int]:
+        """Returns clickable descendants of `overlay` that lie inside its bounds."""
+        region = self.rect(overlay)
+        if region is None:
+            return []
+        return sorted(
+            position for position in self.index.contained_in(region)
+            if position in self.clickable and self.is_descendant(position, overlay)
+        )
+
+    def is_docked(self, position: int, screen_width: int, screen_height: int) -> bool:
+        """Whether the node spans the screen width and sits against the top or bottom edge."""
+        x1, y1, x2, y2 = self.rect(position)
+        if (x2 - x1) < screen_width * DOCKED_WIDTH_RATIO:
+            return False
+        return y1 <= DOCKED_EDGE_TOLERANCE or y2 >= screen_height - DOCKED_EDGE_TOLERANCE
+
+    def overlay_layer(self, position: int, occluded: List[int]) -> int:
+        """
+        Returns the outermost ancestor of `position` (or the node itself) whose subtree
+        contains none of the `occluded` nodes, i.e. the layer drawn over them.
+        """
+        layer = position
+        ancestor = self.parent[position]
+        while ancestor > 0 and not any(self.is_descendant(node, ancestor) for node in occluded):
+            layer = ancestor
+            ancestor = self.parent[ancestor]
+        return layer
+
+    def is_scrim_layer(self, layer: int, screen_area: int) -> bool:
+        """
+        A layer looks like a modal if it is its own window (a direct child of the root) or
+        a near full-screen container stacked over the content, as dimmed backgrounds are.
+        """
+        if layer == 0:
+            return False
+        if self.parent[layer] == 0:
+            return True
+        rect = self.rect(layer)
+        return rect is not None and rect_area(rect) / screen_area > MAX_OVERLAY_AREA_RATIO
+
+    def topmost_overlay(self, screen_width: int, screen_height: int) -> Optional[int]:
+        """
+        Finds the topmost overlay container, scanning nodes from the top of the z-order.
+
+        A container qualifies if it is a known dialog/popup class or resource-id. Otherwise
+        it must cover clickables from other subtrees drawn below it, not be docked chrome
+        like a nav bar, and sit in a scrim-like layer: a separate window or a full-screen
+        container stacked over the content. Clickables that merely scroll under persistent
+        chrome therefore do not make a popup.
+        """
+        root_rect = self.rect(0)
+        if not (screen_width and screen_height) and root_rect:
+            screen_width = root_rect[2] - root_rect[0]
+            screen_height = root_rect[3] - root_rect[1]
+        screen_area = screen_width * screen_height
+        if not screen_area:
+            return None
+        for position in range(len(self.nodes) - 1, 0, -1):
+            node = self.nodes[position]
+            rect = self.rect(position)
+            if rect is None or len(node) == 0 or position in self.clickable:
+                continue
+            area_ratio = rect_area(rect) / screen_area
+            if not MIN_OVERLAY_AREA_RATIO <= area_ratio <= MAX_OVERLAY_AREA_RATIO:
+                continue
+            if not any(child in self.clickable for child in range(position + 1, self.subtree_end[position] + 1)):
+                continue
+            resource_id = node.get('resource-id', '')
+            if node.tag in OVERLAY_CLASSES or any(hint in resource_id for hint in OVERLAY_RESOURCE_HINTS):
+                return position
+            if self.is_docked(position, screen_width, screen_height):
+                continue
+            occluded = self.occluded_by(position)
+            if occluded and self.is_scrim_layer(self.overlay_layer(position, occluded), screen_area):
+                return position
+        return None
+
+    def close_icon_candidate(self, overlay: int) -> Optional[int]:
+        """
+        Returns the small clickable closest to the overlay's top-right corner, where
+        close icons usually sit, or None if there is none nearby.
+        """
+        region = self.rect(overlay)
+        if region is None:
+            return None
+        x1, y1, x2, y2 = region
+        radius = max(48, min(x2 - x1, y2 - y1) // 6)
+        max_icon_area = rect_area(region) * 0.05
+        candidates = [
+            position for position in self.inside(overlay)
+            if rect_area(self.rect(position)) <= max_icon_area
+        ]
+        return self.index.nearest((x2, y1), radius, keys=candidates)
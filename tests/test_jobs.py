@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from fastapi.testclient import TestClient
+
+import main
+from jobs import Job, JobStore
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        CallbackHandler.received.append(json.loads(body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def callback_server():
+    CallbackHandler.received = []
+    server = HTTPServer(("127.0.0.1", 0), CallbackHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/callback"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Stands in for the LLM-backed pipeline so the job plumbing is tested on its own.
+    def handler(request):
+        return {"status": "success", "message": "success", "request_id": request.request_id,
+                "agent_response": {"popup_detection": False}}
+
+    monkeypatch.setattr(main.job_manager, "handler", handler)
+    return TestClient(main.app)
+
+
+def wait_for(condition, timeout_s=5.0):
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_job_runs_and_delivers_callback(client, callback_server):
+    response = client.post("/jobs", json={"request_id": "req-1", "xml": "<hierarchy/>", "callback_url": callback_server})
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+
+    assert wait_for(lambda: client.get(f"/jobs/{job_id}").json().get("callback_status") == "delivered")
+    job = client.get(f"/jobs/{job_id}").json()
+    assert job["state"] == "completed"
+    assert job["request_id"] == "req-1"
+    assert job["result"]["agent_response"] == {"popup_detection": False}
+
+    assert len(CallbackHandler.received) == 1
+    callback = CallbackHandler.received[0]
+    assert callback["job_id"] == job_id
+    assert callback["result"] == job["result"]
+
+
+def test_completed_job_drops_its_request(client):
+    job_id = client.post("/jobs", json={"request_id": "req-2", "image": "aGVsbG8="}).json()["job_id"]
+    assert wait_for(lambda: client.get(f"/jobs/{job_id}").json()["state"] == "completed")
+    assert main.job_manager.get(job_id).request is None
+
+
+def test_unknown_job_returns_404(client):
+    assert client.get("/jobs/does-not-exist").status_code == 404
+
+
+def test_store_caps_completed_jobs():
+    store = JobStore(max_completed=2)
+    jobs = []
+    for index in range(4):
+        job = Job(type("Request", (), {"request_id": f"req-{index}"})())
+        job.finished_at = time.time() + index
+        store.add(job)
+        jobs.append(job)
+    assert store.get(jobs[0].job_id) is None
+    assert store.get(jobs[1].job_id) is None
+    assert store.get(jobs[3].job_id) is jobs[3]
+
+
+def test_jobs_respond_while_invoke_is_running(client, monkeypatch):
+    started, release, finished = threading.Event(), threading.Event(), threading.Event()
+
+    def slow_request(request):
+        started.set()
+        release.wait(timeout=5)
+        return {"status": "success", "request_id": request.request_id}
+
+    monkeypatch.setattr(main, "process_api_request", slow_request)
+    # One event loop for every request, as under uvicorn.
+    with client:
+        def invoke():
+            client.post("/invoke", json={"request_id": "slow", "xml": "<hierarchy/>"})
+            finished.set()
+
+        invoke_thread = threading.Thread(target=invoke)
+        invoke_thread.start()
+        assert started.wait(timeout=5)
+        try:
+            response = client.post("/jobs", json={"request_id": "req-3", "xml": "<hierarchy/>"})
+            assert response.status_code == 202
+            assert client.get(f"/jobs/{response.json()['job_id']}").status_code == 200
+            assert not finished.is_set()
+        finally:
+            release.set()
+            invoke_thread.join()
@@ -0,0 +1,43 @@
+from elements import ContextElement, InteractableElement
+from popup_signatures import signature_library
+
+BUTTON = "android.widget.Button"
+TEXT = "android.widget.TextView"
+
+
+def buttons(*labels):
+    return {f"element_{index}": InteractableElement(f"element_{index}", text=label, type=BUTTON) for index, label in enumerate(labels)}
+
+
+def texts(*labels):
+    return [ContextElement(TEXT, text=label) for label in labels]
+
+
+def test_non_dismissal_action_alone_does_not_match():
+    play_services = texts("Foo won't run without Google Play services, which are missing from your phone.")
+    assert signature_library.match(buttons("Update"), play_services) is None
+
+    rating = texts("Enjoying Foo?", "Tap a star to rate it on the Play Store.")
+    assert signature_library.match(buttons("Rate now"), rating) is None
+
+    cookies = texts("We use cookies to improve your experience.")
+    assert signature_library.match(buttons("Cookie settings"), cookies) is None
+
+
+def test_dismissal_action_is_primary_and_non_dismissal_is_alternate():
+    elements = buttons("Rate now", "Not now")
+    match = signature_library.match(elements, texts("Enjoying Foo?"))
+    assert match["name"] == "app_rating_prompt"
+    assert match["primary"][0] == "element_1"
+    assert [element_id for element_id, _ in match["alternates"]] == ["element_0"]
+
+
+def test_permission_prompt_without_deny_does_not_match():
+    package = "com.android.permissioncontroller"
+    allow = InteractableElement("element_0", text="Allow", resource_id=f"{package}:id/permission_allow_button", type=BUTTON)
+    assert signature_library.match({"element_0": allow}, texts("Allow Foo to access your location?")) is None
+
+    deny = InteractableElement("element_1", text="Don't allow", resource_id=f"{package}:id/permission_deny_button", type=BUTTON)
+    match = signature_library.match({"element_0": allow, "element_1": deny})
+    assert match["name"] == "android_runtime_permission"
+    assert match["primary"][0] == "element_1"
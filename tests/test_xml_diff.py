@@ -0,0 +1,98 @@
+import random
+import xml.etree.ElementTree as ET
+
+from utils import extract_popup_details
+from xml_diff import hierarchy_cache
+
+FRAME = "android.widget.FrameLayout"
+LINEAR = "android.widget.LinearLayout"
+TAGS = (LINEAR, "android.widget.TextView", "android.widget.Button", "android.widget.ImageView")
+
+
+def node(tag, parent, rng, index):
+    y = index * 10 % 2400
+    attributes = {"bounds": f"[0,{y}][1080,{y + 10}]"}
+    if tag == "android.widget.Button" or rng.random() < 0.2:
+        attributes["clickable"] = "true"
+    if tag != LINEAR or rng.random() < 0.3:
+        attributes["text"] = f"text {index}"
+    if tag == "android.widget.ImageView":
+        attributes["resource-id"] = f"app:id/image_{index}"
+    return ET.SubElement(parent, tag, attributes)
+
+
+def random_hierarchy(rng, size=60):
+    root = ET.Element("hierarchy", {"width": "1080", "height": "2400"})
+    frame = ET.SubElement(root, FRAME, {"bounds": "[0,0][1080,2400]"})
+    containers = [frame]
+    for index in range(size):
+        child = node(rng.choice(TAGS), rng.choice(containers), rng, index)
+        if child.tag == LINEAR:
+            containers.append(child)
+    return root
+
+
+def mutate(root, rng, step):
+    elements = [element for element in root.iter() if element.tag != "hierarchy"][1:]
+    action = rng.choice(("add", "remove", "edit"))
+    if action == "add" or not elements:
+        parents = [element for element in root.iter() if element.tag in (FRAME, LINEAR)]
+        node(rng.choice(TAGS), rng.choice(parents), rng, 1000 + step)
+    elif action == "remove":
+        target = rng.choice(elements)
+        parent = next(element for element in root.iter() if target in list(element))
+        parent.remove(target)
+    else:
+        rng.choice(elements).set("text", f"edited {step}")
+
+
+def extraction(result):
+    return (
+        [element.to_dict() for element in result["content"]],
+        {element_id: element.to_dict() for element_id, element in result["interactable_elements"].items()},
+        result["is_popup"],
+        result["details"],
+    )
+
+
+def test_incremental_extraction_matches_full_extraction():
+    rng = random.Random(7)
+    for sequence in range(40):
+        root = random_hierarchy(rng)
+        cache_key = f"equivalence-{sequence}"
+        for step in range(6):
+            xml = ET.tostring(root, encoding="unicode")
+            full = extract_popup_details(xml)
+            incremental = extract_popup_details(xml, cache_key=cache_key)
+            assert extraction(incremental) == extraction(full)
+            mutate(root, rng, step)
+
+
+def test_unchanged_subtrees_are_reused():
+    rng = random.Random(11)
+    root = random_hierarchy(rng)
+    xml = ET.tostring(root, encoding="unicode")
+    extract_popup_details(xml, cache_key="reuse")
+    result = extract_popup_details(xml, cache_key="reuse")
+    assert result["changes"]["reused_ratio"] == 1.0
+    assert result["changes"]["added"] == result["changes"]["removed"] == result["changes"]["changed"] == []
+
+
+def test_snapshot_memory_is_linear_in_nodes_and_records():
+    # A deep hierarchy with many text nodes at every level; storing each subtree's records
+    # at every ancestor would hold records x depth references.
+    depth, texts_per_level = 150, 100
+    root = ET.Element("hierarchy", {"width": "1080", "height": "2400"})
+    parent = root
+    for level in range(depth):
+        parent = ET.SubElement(parent, FRAME, {"bounds": "[0,0][1080,2400]"})
+        for index in range(texts_per_level):
+            ET.SubElement(parent, "android.widget.TextView", {"text": f"{level}-{index}", "bounds": "[0,0][10,10]"})
+
+    result = extract_popup_details(ET.tostring(root, encoding="unicode"), cache_key="deep")
+    snapshot = hierarchy_cache.get("deep")
+    node_count = sum(1 for _ in root.iter())
+    references = sum(len(own) + len(child_keys) for own, child_keys in snapshot.records.values())
+    assert len(result["content"]) == depth * texts_per_level
+    assert len(snapshot.records) <= node_count
+    assert references <= 2 * node_count
@@ -2,38 +2,52 @@ from typing import Any
 import xml.etree.ElementTree as ET
 import base64
 import os
-import requests
+import sys
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 from datetime import datetime
 import uuid
 from logger_config import logger
 from typing import Any, Union, Dict, List
+from limits import MAX_REQUEST_BYTES, InputTooLarge, fetch_limited, parse_xml_with_limits
+from elements import ActionableElement, ContextElement, InteractableElement, format_bounds, parse_bounds
+from spatial_index import HierarchyIndex
+from xml_diff import IncrementalExtractor, hierarchy_cache
 
 # import matplotlib.pyplot as plt
 
-def extract_popup_details(xml_input) -> Dict[str, Union[bool, List[Any], Dict[Any, Any]]]:   
+def extract_popup_details(xml_input, cache_key=None, node_id=None, timeout=None) -> Dict[str, Union[bool, List[Any], Dict[Any, Any]]]:   
     """
     Determines if the given XML represents a popup and extracts its context (non-clickable text and images)
     as well as interactable (clickable) elements.
     
     Args:
         xml_input (str): XML file path, URL, or XML content representing the screen hierarchy
+        cache_key (optional): Enables incremental mode. The hierarchy is diffed against the previous one
+            parsed under the same key, unchanged subtrees are not walked again but take their records
+            from the previous parse, and the changed region
+            is reported under 'changes'.
+        node_id (optional): Identifier of the current screen, reported back by the next diff.
+        timeout (float, optional): Seconds to wait when fetching the XML from a URL
+
+    Returns:
+        dict with 'is_popup', 'content', 'interactable_elements' and 'details'. When the XML could
+        not be fetched or parsed, these are empty and 'error' holds the reason.
+
+    Raises:
+        InputTooLarge: if the hierarchy exceeds the node count or depth limits.
     
     """
     try:
         # Parse XML input.
         if isinstance(xml_input, str):
             if xml_input.startswith('http://') or xml_input.startswith('https://'):
-                response = requests.get(xml_input)
-                response.raise_for_status()
-                xml_content = response.text
-                root = ET.fromstring(xml_content)
+                root = parse_xml_with_limits(fetch_limited(xml_input, timeout=timeout))
             elif os.path.isfile(xml_input):
-                tree = ET.parse(xml_input)
-                root = tree.getroot()
+                with open(xml_input, 'r', encoding='utf-8') as xml_file:
+                    root = parse_xml_with_limits(xml_file.read())
             else:
-                root = ET.fromstring(xml_input)
+                root = parse_xml_with_limits(xml_input)
         else:
             raise ValueError("Invalid XML input type.")
         
@@ -51,35 +65,78 @@ def extract_popup_details(xml_input) -> Dict[str, Union[bool, List[Any], Dict[An
         
         # Mutable counter for interactable element IDs.
         element_counter = [1]  # Using a list so inner functions can update it.
+        element_nodes = {}  # element_id -> XML node, for the spatial queries below.
 
-        # Helper functions to compute an element's absolute XPath.
-        def find_path_to_target(current, target):
-            if current is target:
-                return [current]
-            for child in list(current):
-                subpath = find_path_to_target(child, target)
-                if subpath is not None:
-                    return [current] + subpath
-            return None
-
-        def compute_xpath_from_path(path):
-            xpath = ''
-            for i, node in enumerate(path):
-                if i == 0:
-                    xpath += f'/{node.tag}'
-                else:
-                    parent = path[i - 1]
+        incremental = None
+        if cache_key is not None:
+            incremental = IncrementalExtractor(root, previous=hierarchy_cache.get(cache_key), node_id=node_id)
+            get_xpath = incremental.get_xpath
+        else:
+            # Parent map built once so each XPath costs O(depth) instead of a full tree search.
+            parent_map = {child: parent for parent in root.iter() for child in parent}
+
+            def get_xpath(target):
+                steps = []
+                node = target
+                while node is not root:
+                    parent = parent_map.get(node)
+                    if parent is None:
+                        return ''
                     # Calculate the position index among siblings with the same tag.
-                    siblings = [c for c in list(parent) if c.tag == node.tag]
-                    index = siblings.index(node) + 1
-                    xpath += f'/{node.tag}[{index}]'
-            return xpath
-
-        def get_xpath(target):
-            path = find_path_to_target(root, target)
-            if path is not None:
-                return compute_xpath_from_path(path)
-            return ''
+                    index = 1
+                    for sibling in parent:
+                        if sibling is node:
+                            break
+                        if sibling.tag == node.tag:
+                            index += 1
+                    steps.append(f'/{node.tag}[{index}]')
+                    node = parent
+                steps.append(f'/{root.tag}')
+                return ''.join(reversed(steps))
+
+        def make_text(node):
+            # Bounds and resource-id are kept for the signature library's region checks; only the text is reported.
+            resource_id = node.get('resource-id', '')
+            return ContextElement(
+                type='text',
+                text=node.get('text', ''),
+                resource_id=sys.intern(resource_id) if resource_id else '',
+                rect=parse_bounds(node.get('bounds', '')),
+                xpath=get_xpath(node)
+            )
+
+        def make_image(node):
+            resource_id = node.get('resource-id', '')
+            return ContextElement(
+                type='image',
+                resource_id=sys.intern(resource_id) if resource_id else '',
+                content_desc=node.get('content-desc', ''),
+                rect=parse_bounds(node.get('bounds', '')),
+                xpath=get_xpath(node)
+            )
+
+        def make_interactable(node):
+            return InteractableElement.from_node('', node, xpath=get_xpath(node))
+
+        image_tags = ('android.widget.ImageView', 'android.widget.ImageButton', 'android.widget.Image')
+
+        def node_records(node):
+            # The records one node contributes, matching the findall queries of the full extraction below.
+            records = []
+            clickable = node.get('clickable', 'false') == 'true'
+            if node.get('text') and not clickable:
+                records.append(('text', make_text(node)))
+            if clickable:
+                records.append(('interactable', make_interactable(node)))
+            elif node.tag in image_tags and (node.get('src', '') or node.get('resource-id', '') or node.get('content-desc', '')):
+                records.append((node.tag, make_image(node)))
+            return records
+
+        def add_interactable(template, node):
+            element_id = str(element_counter[0])
+            popup_result['interactable_elements'][element_id] = template.with_id(element_id)
+            element_nodes[element_id] = node
+            element_counter[0] += 1
 
         # Find potential popup layouts using common XPath queries.
         popup_layouts = [
@@ -96,13 +153,10 @@ def extract_popup_details(xml_input) -> Dict[str, Union[bool, List[Any], Dict[An
                 continue
             
             # Extract bounds (expected format: "[x1,y1][x2,y2]").
-            bounds = first_component.get('bounds', '')
-            try:
-                bounds_parts = bounds.strip('[]').split('][')
-                x1, y1 = map(int, bounds_parts[0].split(','))
-                x2, y2 = map(int, bounds_parts[1].split(','))
-            except (ValueError, IndexError):
+            rect = parse_bounds(first_component.get('bounds', ''))
+            if rect is None:
                 continue
+            x1, y1, x2, y2 = rect
             
             # Calculate dimensions and center position.
             component_width = x2 - x1
@@ -131,83 +185,114 @@ def extract_popup_details(xml_input) -> Dict[str, Union[bool, List[Any], Dict[An
                     text = elem.get('text', '')
                     clickable = elem.get('clickable', 'false') == 'true'
                     if text and not clickable:
-                        popup_result['content'].append({
-                            'xpath': get_xpath(elem),
-                            'type': 'text',
-                            'text': text
-                        })
+                        popup_result['content'].append(make_text(elem))
             
             def extract_actions(element):
                 # Add clickable elements (all get an element_id).
                 clickable_elements = element.findall('.//*[@clickable="true"]')
                 for action_elem in clickable_elements:
-                    element_id = str(element_counter[0]) 
-                    action_details = {
-                        '_id': element_id,
-                        'text': action_elem.get('text', ''),
-                        'resouce_id': action_elem.get('resource-id', ''),
-                        'type': action_elem.tag.split('.')[-1],
-                        'bounds': action_elem.get('bounds', ''),
-                        'content_desc': action_elem.get('content-desc', ''),
-                        'enabled': action_elem.get('enabled', 'true') == 'true',
-                        'focused': action_elem.get('focused', 'false') == 'true',
-                        'scrollable': action_elem.get('scrollable', 'false') == 'true',
-                        'long_clickable': action_elem.get('long-clickable', 'false') == 'true',
-                        'password': action_elem.get('password', 'false') == 'true',
-                        'selected': action_elem.get('selected', 'false') == 'true',
-                        'xpath': get_xpath(action_elem),
-                    }
-                    popup_result.get('interactable_elements', {})[element_id] = action_details
-                    element_counter[0] += 1
+                    add_interactable(make_interactable(action_elem), action_elem)
             
             def extract_non_clickable_images(element):
                 # Look for image-related tags and add non-clickable images as context (type "image").
-                image_tags = [
-                    './/android.widget.ImageView',
-                    './/android.widget.ImageButton',
-                    './/android.widget.Image'
-                ]
                 for tag in image_tags:
-                    for img_elem in element.findall(tag):
+                    for img_elem in element.findall(f'.//{tag}'):
                         if img_elem.get('clickable', 'false') == 'true':
                             continue  # Already captured as an interactable element.
-                        img_context = {
-                            'xpath': get_xpath(img_elem),
-                            'type': 'image',
-                            'resource_id': img_elem.get('resource-id', ''),
-                            'content_desc': img_elem.get('content-desc', ''),
-                            'bounds': img_elem.get('bounds', '')
-                        }
                         drawable = img_elem.get('src', '')
-                        if drawable or img_context['resource_id'] or img_context['content_desc']:
-                            popup_result['content'].append(img_context)
+                        if drawable or img_elem.get('resource-id', '') or img_elem.get('content-desc', ''):
+                            popup_result['content'].append(make_image(img_elem))
+
+            def extract_incrementally(element):
+                # Same output and order as the three functions above, with unchanged subtrees reused.
+                records = incremental.subtree_records(element, node_records)
+                popup_result['content'].extend(record for category, record in records if category == 'text')
+                for category, record in records:
+                    if category == 'interactable':
+                        add_interactable(record, incremental.node_at(record.xpath))
+                for tag in image_tags:
+                    popup_result['content'].extend(record for category, record in records if category == tag)
             
             # Apply extraction functions on the found component, regardless of popup status.
-            extract_text(first_component)
-            extract_actions(first_component)
-            extract_non_clickable_images(first_component)
+            if incremental:
+                extract_incrementally(first_component)
+            else:
+                extract_text(first_component)
+                extract_actions(first_component)
+                extract_non_clickable_images(first_component)
+
+        apply_overlay_queries(root, screen_width, screen_height, popup_result, element_nodes)
+
+        if incremental:
+            popup_result['changes'] = incremental.changes()
+            hierarchy_cache.put(cache_key, incremental.snapshot)
         
         logger.info(f"XML parsing output to check for popups using rules: {popup_result}")
         return popup_result
     
+    except InputTooLarge:
+        raise
     except ET.ParseError as e:
         logger.error(f"XML Parse Error: {e}")
-        return {
-            'is_popup': False,
-            'content': [],
-            'interactable_elements': {},
-            'details': {}
-        }
+        return failed_popup_result(str(e))
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
-        return {
-            'is_popup': False,
-            'content': [],
-            'interactable_elements': {},
-            'details': {}
-        }
+        return failed_popup_result(str(e))
+
+def failed_popup_result(error) -> Dict[str, Any]:
+    """The empty `extract_popup_details` result for an XML that could not be fetched or parsed."""
+    return {
+        'is_popup': False,
+        'content': [],
+        'interactable_elements': {},
+        'details': {},
+        'error': error
+    }
+
+def apply_overlay_queries(root, screen_width, screen_height, popup_result, element_nodes):
+    """
+    Runs the spatial overlay queries over the hierarchy and folds them into `popup_result`.
 
-def process_actionable_elements(actionable_elements) -> dict[Any, Any]:
+    When a topmost overlay is found it becomes the popup region, clickables it occludes
+    are pruned from the candidates, and the ids inside it and of the likely close icon
+    are recorded in `details`.
+    """
+    hierarchy = HierarchyIndex(root)
+    overlay = hierarchy.topmost_overlay(screen_width, screen_height)
+    if overlay is None:
+        return
+
+    x1, y1, x2, y2 = hierarchy.rect(overlay)
+    occluded = set(hierarchy.occluded_by(overlay))
+    inside = set(hierarchy.inside(overlay))
+    close_icon = hierarchy.close_icon_candidate(overlay)
+
+    interactable_elements = popup_result['interactable_elements']
+    overlay_element_ids = []
+    close_icon_id = None
+    for element_id, node in element_nodes.items():
+        position = hierarchy.order[node]
+        if position in occluded:
+            interactable_elements.pop(element_id, None)
+        elif position in inside:
+            overlay_element_ids.append(element_id)
+            if position == close_icon and close_icon_id is None:
+                close_icon_id = element_id
+
+    popup_result['is_popup'] = True
+    popup_result['details'] = {
+        'width': x2 - x1,
+        'height': y2 - y1,
+        'center_x': (x1 + x2) / 2,
+        'center_y': (y1 + y2) / 2,
+        'bounds': format_bounds((x1, y1, x2, y2)),
+        'overlay_element_ids': overlay_element_ids,
+        'occluded_count': len(occluded),
+    }
+    if close_icon_id is not None:
+        popup_result['details']['close_icon_id'] = close_icon_id
+
+def process_actionable_elements(actionable_elements) -> dict[Any, ActionableElement]:
 
     actionable_element_dict = {}
 
@@ -228,24 +313,25 @@ def process_actionable_elements(actionable_elements) -> dict[Any, Any]:
             if "name" in attribute and "value" in attribute:
                 processed_attributes[attribute['name']] = attribute['value']
 
-        processed_element = {
-            "node_id": element.get('elementId'),
-            "description": element_description,
-            "heuristic_score": 0,
-            "attributes": processed_attributes
-        }
+        processed_element = ActionableElement(
+            node_id=element.get('elementId'),
+            description=element_description,
+            heuristic_score=0,
+            attributes=processed_attributes
+        )
 
         actionable_element_dict[str(element.get('elementId'))] = processed_element
 
     return actionable_element_dict
 
-def annotate_image_using_actionable_elements(base64_image, actionable_element_dict):
+def annotate_image_using_actionable_elements(base64_image, actionable_element_dict, image_data=None):
     """
     Annotate the image with bounding boxes and element IDs for all interactable elements.
     
     Args:
         base64_image (str): Base64 encoded image string
         xml_data (dict): Processed XML data containing interactable elements
+        image_data (bytes, optional): The already decoded image, used instead of decoding base64_image
         
     Returns:
         str: Base64 encoded annotated image
@@ -255,7 +341,8 @@ def annotate_image_using_actionable_elements(base64_image, actionable_element_di
     # Decode base64 image
 
     # print(xml_data)
-    image_data = base64.b64decode(base64_image)
+    if image_data is None:
+        image_data = base64.b64decode(base64_image)
     image = Image.open(BytesIO(image_data))
 
     if image.mode == 'RGBA':
@@ -272,21 +359,12 @@ def annotate_image_using_actionable_elements(base64_image, actionable_element_di
     # Draw bounding boxes and element IDs for all interactable elements
     if actionable_element_dict:
         for element_id, element_data in actionable_element_dict.items():
-            attributes = element_data.get('attributes', {})
-            bounds = None
-            if attributes and "bounds" in attributes:
-                bounds = attributes.get("bounds")
-            elif "bounds" in element_data:
-                bounds = element_data.get("bounds")
-            if isinstance(bounds, str):
-                # Parse bounds string like "[0,0][100,100]"
-                coords = bounds.replace("][", ",").strip("[]").split(",")
-                if len(coords) == 4:
-                    x1, y1, x2, y2 = map(int, coords)
-                    # Draw rectangle
-                    draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=3)  # Increased outline width
-                    # Draw element ID
-                    draw.text((x1-30, y1-30), str(element_id), fill="red", font=font)  # Position text at top-left corner
+            if element_data.rect is not None:
+                x1, y1, x2, y2 = element_data.rect
+                # Draw rectangle
+                draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=3)  # Increased outline width
+                # Draw element ID
+                draw.text((x1-30, y1-30), str(element_id), fill="red", font=font)  # Position text at top-left corner
 
     # plt.figure(figsize=(8, 8))
     # plt.imshow(image)
@@ -347,17 +425,12 @@ def annotate_image_using_xml(base64_image, xml_data):
     # Draw bounding boxes and element IDs for all interactable elements
     if xml_data and "interactable_elements" in xml_data:
         for element_id, element_data in xml_data["interactable_elements"].items():
-            if "bounds" in element_data:
-                bounds = element_data["bounds"]
-                if isinstance(bounds, str):
-                    # Parse bounds string like "[0,0][100,100]"
-                    coords = bounds.replace("][", ",").strip("[]").split(",")
-                    if len(coords) == 4:
-                        x1, y1, x2, y2 = map(int, coords)
-                        # Draw rectangle
-                        draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=3)  # Increased outline width
-                        # Draw element ID
-                        draw.text((x1-30, y1-30), element_id, fill="red", font=font)  # Position text at top-left corner
+            if element_data.rect is not None:
+                x1, y1, x2, y2 = element_data.rect
+                # Draw rectangle
+                draw.rectangle([(x1, y1), (x2, y2)], outline="red", width=3)  # Increased outline width
+                # Draw element ID
+                draw.text((x1-30, y1-30), element_id, fill="red", font=font)  # Position text at top-left corner
 
 
     
@@ -387,23 +460,102 @@ def annotate_image_using_xml(base64_image, xml_data):
 
     return annotated_base64
 
-def encode_image(input_source):
+def popup_region(processed_xml):
+    """
+    Returns the popup region detected by `extract_popup_details` as (x1, y1, x2, y2), or None.
+    """
+    details = (processed_xml or {}).get('details') or {}
+    rect = parse_bounds(details.get('bounds'))
+    if rect is None and details.get('width') and details.get('height'):
+        half_width, half_height = details['width'] / 2, details['height'] / 2
+        rect = (
+            int(details['center_x'] - half_width),
+            int(details['center_y'] - half_height),
+            int(details['center_x'] + half_width),
+            int(details['center_y'] + half_height),
+        )
+    return rect
+
+def annotate_popup_crop(base64_image, actionable_element_dict, region, padding=0.05, thumbnail_size=512, max_area_ratio=0.8, image_data=None):
+    """
+    Crop the popup region out of the screenshot and annotate it, plus a small whole-screen thumbnail.
+
+    Args:
+        base64_image (str): Base64 encoded image string
+        actionable_element_dict (dict): Elements with parsed rects, keyed by element ID
+        region (tuple): Popup region (x1, y1, x2, y2) in screenshot pixels
+        padding (float): Padding around the region, as a fraction of the screen's longer side
+        thumbnail_size (int): Longest side of the context thumbnail in pixels
+        max_area_ratio (float): Largest fraction of the screen the crop may cover to be worth sending
+        image_data (bytes, optional): The already decoded image, used instead of decoding base64_image
+
+    Returns:
+        tuple: (base64 annotated crop, base64 thumbnail, crop box (x1, y1, x2, y2)), or None when
+        the padded region falls outside the screenshot or covers too much of it to save anything
+    """
+    if image_data is None:
+        image_data = base64.b64decode(base64_image)
+    image = Image.open(BytesIO(image_data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    pad = int(max(image.width, image.height) * padding)
+    x1, y1, x2, y2 = region
+    crop_box = (max(0, x1 - pad), max(0, y1 - pad), min(image.width, x2 + pad), min(image.height, y2 + pad))
+    if crop_box[2] <= crop_box[0] or crop_box[3] <= crop_box[1]:
+        return None
+    crop_area = (crop_box[2] - crop_box[0]) * (crop_box[3] - crop_box[1])
+    if crop_area > image.width * image.height * max_area_ratio:
+        return None
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+
+    crop = image.crop(crop_box)
+    draw = ImageDraw.Draw(crop)
+    try:
+        font = ImageFont.truetype("Arial.ttf", 50)
+    except IOError:
+        font = ImageFont.load_default()
+
+    # Element IDs are drawn in crop coordinates; elements outside the crop are left out.
+    offset_x, offset_y = crop_box[0], crop_box[1]
+    for element_id, element_data in actionable_element_dict.items():
+        rect = element_data.rect
+        if rect is None or rect[2] <= crop_box[0] or rect[0] >= crop_box[2] or rect[3] <= crop_box[1] or rect[1] >= crop_box[3]:
+            continue
+        ex1, ey1, ex2, ey2 = rect[0] - offset_x, rect[1] - offset_y, rect[2] - offset_x, rect[3] - offset_y
+        draw.rectangle([(ex1, ey1), (ex2, ey2)], outline="red", width=3)
+        draw.text((max(0, ex1 - 30), max(0, ey1 - 30)), str(element_id), fill="red", font=font)
+
+    buffered = BytesIO()
+    crop.save(buffered, format="JPEG")
+    annotated_crop = base64.b64encode(buffered.getvalue()).decode()
+    buffered = BytesIO()
+    thumbnail.save(buffered, format="JPEG", quality=70)
+    encoded_thumbnail = base64.b64encode(buffered.getvalue()).decode()
+    return annotated_crop, encoded_thumbnail, crop_box
+
+def encode_image(input_source, timeout=None):
     """
     Encodes an image from a file path, file object, or URL into a base64 string.
 
     Args:
     input_source (str or file-like object): The image file path, file object, or URL.
+    timeout (float, optional): Seconds to wait when fetching the image from a URL.
 
     Returns:
     str: Base64 encoded string of the image.
+
+    Raises:
+    InputTooLarge: if the image at the URL exceeds the size limit.
     """
     try:
         if isinstance(input_source, str):
             # Check if it's a URL
             if input_source.startswith('http://') or input_source.startswith('https://'):
-                response = requests.get(input_source)
-                response.raise_for_status()
-                image_data = response.content
+                # Capped so that the base64 encoding stays within the request size limit.
+                image_data = fetch_limited(input_source, timeout=timeout, max_bytes=MAX_REQUEST_BYTES * 3 // 4)
             # Check if it's a file path
             elif os.path.isfile(input_source):
                 with open(input_source, 'rb') as image_file:
@@ -418,6 +570,8 @@ def encode_image(input_source):
         encoded_image = base64.b64encode(image_data).decode()
         return encoded_image
 
+    except InputTooLarge:
+        raise
     except Exception as e:
         print(f"Error encoding image: {e}")
         return None
\ No newline at end of file
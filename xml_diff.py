@@ -0,0 +1,206 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+from elements import format_bounds, parse_bounds
+
+
+def index_hierarchy(root):
+    """
+    Computes every node's absolute XPath and subtree hash in two linear passes.
+
+    Returns:
+        (xpaths, own_hashes, subtree_hashes), each a dict keyed by XML node. The own hash
+        covers the node's tag and attributes; the subtree hash also covers all descendants.
+    """
+    xpaths = {root: f'/{root.tag}'}
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        # Position index among siblings with the same tag.
+        counts = {}
+        for child in node:
+            counts[child.tag] = counts.get(child.tag, 0) + 1
+            xpaths[child] = f'{xpaths[node]}/{child.tag}[{counts[child.tag]}]'
+            stack.append(child)
+
+    own_hashes = {}
+    subtree_hashes = {}
+    # Pre-order reversed visits every child before its parent.
+    for node in reversed(order):
+        own_hash = hash((node.tag, tuple(sorted(node.attrib.items()))))
+        own_hashes[node] = own_hash
+        subtree_hashes[node] = hash((own_hash, tuple(subtree_hashes[child] for child in node)))
+    return xpaths, own_hashes, subtree_hashes
+
+
+class HierarchySnapshot:
+    """
+    What is kept from one parse to diff the next hierarchy of the same run against.
+
+    `nodes` maps XPath -> (subtree hash, own hash, rect). `records` maps a node's (XPath,
+    subtree hash) key to (own, child_keys): the (category, record) pairs extracted from the
+    node itself and the keys of its children. A subtree's records are put back together by
+    walking the keys, so memory stays linear in nodes plus records regardless of depth.
+    """
+    __slots__ = ('node_id', 'nodes', 'records')
+
+    def __init__(self, node_id=None):
+        self.node_id = node_id
+        self.nodes = {}
+        self.records = {}
+
+
+class IncrementalExtractor:
+    """
+    Serves XPaths and element records for `extract_popup_details`.
+
+    Subtrees whose XPath and subtree hash match the previous snapshot of the same run are
+    not walked again; their records are taken from the snapshot as a whole.
+    """
+
+    def __init__(self, root, previous: Optional[HierarchySnapshot] = None, node_id=None):
+        self.root = root
+        self.previous = previous
+        self.xpaths, self.own_hashes, self.subtree_hashes = index_hierarchy(root)
+        self.snapshot = HierarchySnapshot(node_id)
+        for node, xpath in self.xpaths.items():
+            self.snapshot.nodes[xpath] = (self.subtree_hashes[node], self.own_hashes[node], parse_bounds(node.get('bounds', '')))
+        self.nodes_by_xpath = {xpath: node for node, xpath in self.xpaths.items()}
+        self.reused = 0
+        self.extracted = 0
+
+    def get_xpath(self, node) -> str:
+        return self.xpaths.get(node, '')
+
+    def node_at(self, xpath):
+        return self.nodes_by_xpath.get(xpath)
+
+    def _key(self, node):
+        return (self.xpaths[node], self.subtree_hashes[node])
+
+    def _entry(self, key):
+        entry = self.snapshot.records.get(key)
+        if entry is None and self.previous is not None:
+            entry = self.previous.records.get(key)
+        return entry
+
+    def _reuse(self, node, records: list) -> bool:
+        """
+        Appends the stored records of `node`'s subtree to `records` if the subtree is unchanged,
+        carrying its entries into the new snapshot so a later change inside it still reuses the rest.
+        """
+        key = self._key(node)
+        if self._entry(key) is None:
+            return False
+        stack = [key]
+        while stack:
+            key = stack.pop()
+            own, child_keys = self._entry(key)
+            self.snapshot.records[key] = (own, child_keys)
+            records.extend(own)
+            self.reused += len(own)
+            stack.extend(reversed(child_keys))
+        return True
+
+    def subtree_records(self, component, node_records: Callable[[Any], list]) -> list:
+        """
+        Returns the (category, record) pairs of the descendants of `component` in document
+        order. `node_records(node)` gives the pairs a single node contributes; it is only
+        called for nodes in subtrees that changed since the previous snapshot.
+        """
+        records = []
+        stack = list(reversed(list(component)))
+        while stack:
+            node = stack.pop()
+            if self._reuse(node, records):
+                continue
+            own = tuple(node_records(node))
+            self.extracted += len(own)
+            records.extend(own)
+            children = list(node)
+            self.snapshot.records[self._key(node)] = (own, tuple(self._key(child) for child in children))
+            stack.extend(reversed(children))
+        return records
+
+    def changes(self) -> Optional[Dict[str, Any]]:
+        """
+        Reports the topmost added, removed and changed subtrees relative to the previous
+        snapshot, and the union of their bounds. Returns None when there is no previous snapshot.
+        """
+        if self.previous is None:
+            return None
+        previous_nodes = self.previous.nodes
+        added, changed = [], []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            xpath = self.xpaths[node]
+            entry = previous_nodes.get(xpath)
+            if entry is None:
+                added.append(xpath)
+            elif entry[0] == self.subtree_hashes[node]:
+                continue
+            elif entry[1] != self.own_hashes[node]:
+                changed.append(xpath)
+            else:
+                stack.extend(reversed(list(node)))
+
+        current_nodes = self.snapshot.nodes
+        removed = [
+            xpath for xpath in previous_nodes
+            if xpath not in current_nodes and xpath.rsplit('/', 1)[0] in current_nodes
+        ]
+
+        rects = [current_nodes[xpath][2] for xpath in added + changed]
+        rects += [previous_nodes[xpath][2] for xpath in removed]
+        rects = [rect for rect in rects if rect is not None]
+        region = None
+        if rects:
+            region = (
+                min(rect[0] for rect in rects),
+                min(rect[1] for rect in rects),
+                max(rect[2] for rect in rects),
+                max(rect[3] for rect in rects),
+            )
+
+        total = self.reused + self.extracted
+        return {
+            'previous_node_id': self.previous.node_id,
+            'added': sorted(added),
+            'removed': sorted(removed),
+            'changed': sorted(changed),
+            'bounds': format_bounds(region),
+            'reused_ratio': round(self.reused / total, 3) if total else 1.0,
+        }
+
+
+class HierarchyCache:
+    """Thread-safe LRU of the latest HierarchySnapshot per run."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[HierarchySnapshot]:
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is not None:
+                self._entries.move_to_end(key)
+            return snapshot
+
+    def put(self, key, snapshot: HierarchySnapshot):
+        with self._lock:
+            self._entries[key] = snapshot
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+hierarchy_cache = HierarchyCache()